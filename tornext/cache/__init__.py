@@ -20,34 +20,58 @@ Redis-based cache helpers.
 """
 from __future__ import absolute_import
 
+import sys
 import hmac
+import math
+import time
+import fnmatch
 import hashlib
 import logging
 import functools
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
-from redis.client import Redis
+from tornado import gen, escape
+from tornado.ioloop import IOLoop
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+from tornado.concurrent import Future, is_future
 
-from tornext.sharding import Sharding
+from tornext import compat
+from tornext.cache.serializers import Serializer
 
 
 logger = logging.getLogger(__name__)
 
 
-def cache(expires=7200):
+def cache(expires=7200, stale=0):
+    """Cache the response of a `CacheMixin` handler method.
+
+    Args:
+        expires: period (seconds) the cached response is fresh (soft TTL).
+        stale: additional period (seconds) the response may be served stale
+            while it is refreshed in background (hard TTL = expires + stale).
+    """
     def wrapper(func):
         @functools.wraps(func)
         def function(handler, *args, **kwargs):
             handler.expires = expires
+            handler.stale   = stale
             return func(handler, *args, **kwargs)
         return function
     return wrapper
 
 
 class AbstractCache(object):
+    """Cache backend contract.
+
+    Blocking backends return plain values, non-blocking backends
+    (`blocking` is False) return `tornado.concurrent.Future`; callers that
+    accept any backend should wrap results with `tornado.gen.maybe_future`.
+
+    Values are stored as given, callers encode them with `serializer`
+    (`tornext.cache.serializers.Serializer`), which can be replaced per backend.
+    """
+    serializer = Serializer()
+
+    blocking = True
 
     def get(self, key):
         raise NotImplementedError
@@ -65,107 +89,176 @@ class AbstractCache(object):
         raise NotImplementedError
 
 
+    def get_many(self, keys):
+        """Get cached items for `keys`.
 
-class RedisCache(AbstractCache):
-    """
-    Default sharding settings for single node (direct settings for `redis.client.StrictRedis`).
-    {
-        'host': 'localhost', 'port': 6379,
-        'db': 0, 'password': None, 'socket_timeout': None,
-        'socket_connect_timeout': None,
-        'socket_keepalive': None, 'socket_keepalive_options': None,
-        'connection_pool': None, 'unix_socket_path': None,
-        'encoding': 'utf-8', 'encoding_errors': 'strict',
-        'charset': None, 'errors': None,
-        'decode_responses': False, 'retry_on_timeout': False,
-        'ssl': False, 'ssl_keyfile': None, 'ssl_certfile': None,
-        'ssl_cert_reqs': None, 'ssl_ca_certs': None
-    }
+        Returns: list of values (None for missing keys) in the order of `keys`.
+        """
+        return [self.get(key) for key in keys]
 
-    """
-    def __init__(self, urls, **settings):
+
+    def set_many(self, mapping, timeout=None):
+        """Set every key/value pair of `mapping` with the same `timeout`."""
+        for key, value in compat.iteritems(mapping):
+            self.set(key, value, timeout)
+
+
+    def delete_many(self, keys):
+        """Delete cached items with given keys."""
+        self.delete(*keys)
+
+
+    def add(self, key, value, timeout=None):
+        """Set the value for key only if it doesn't exist yet.
+
+        Returns: boolean value indicating if the value was set.
         """
-        Args:
-            urls: list of connection urls for `redis.client.StrictRedis#from_url`.
-            settings: additional settings for redis client.
+        raise NotImplementedError
+
+
+    def incr(self, key, delta=1):
+        """Increment the integer value of key (starting from 0).
 
-        Attributes:
-            mapping (dict): maintain the connection url & corresponding Redis client mapping.
-            sharding: `tornext.sharding.Sharding` instance for dispatching requests.
+        Returns: value after the increment.
         """
-        self.sharding = Sharding(urls)
-        self.mapping  = dict([(url, Redis.from_url(url)) for url in urls])
+        raise NotImplementedError
 
 
-    def get_node(self, key):
-        """Get the corresponding sharding node for the given key.
+def chain(result, callback):
+    """Apply `callback` to a backend result.
 
-        Args:
-            key (str): md5-based cache key.
+    Args:
+        result: plain value or `Future` returned by a cache backend.
+        callback: function called with the resolved value.
 
-        Returns:
-            instance of `redis.client.Redis` for accessing single Redis node.
-        """
-        url = self.sharding.get_node(key)
-        return self.mapping.get(url)
+    Returns: `callback(result)`, wrapped into a `Future` if `result` is one.
+    """
+    if not is_future(result):
+        return callback(result)
+    future = Future()
+    def resolve(done):
+        try:
+            future.set_result(callback(done.result()))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+    result.add_done_callback(resolve)
+    return future
 
 
-    def exists(self, key):
-        """Check if `key` exists.
+# backends live in their own modules, they depend on `AbstractCache` & `chain` above.
+from tornext.cache.redis import RedisCache, AsyncRedisCache
+from tornext.cache.local import LocalCache, TieredCache
 
-        Args:
-            key: hex-digested cache key.
 
-        Returns: boolean value indicating if corresponding `key` exists.
-        """
-        node = self.get_node(key)
-        return node and node.exists(key) or False
+def _log_failure(future):
+    """Done callback for fire-and-forget cache writes."""
+    if future.exception() is not None:
+        logger.warning('Cache write failed: %r', future.exception())
 
 
-    def get(self, key):
-        """Get cached item via the md5 key.
+def _background(result):
+    """Let a backend result complete on its own, logging failures."""
+    if is_future(result):
+        IOLoop.current().add_future(result, _log_failure)
 
-        Fetch the corresponding sharding node for consequent requests.
 
-        Args:
-            key: md5-based cache key.
+def expand_tags(tags):
+    """Add the namespace wildcard of every tag, e.g. 'user:42' -> 'user:42', 'user:*'."""
+    expanded = []
+    for tag in tags:
+        expanded.append(tag)
+        if ':' in tag and not tag.endswith(':*'):
+            expanded.append('%s:*' % tag.rsplit(':', 1)[0])
+    return sorted(set(expanded))
 
-        Returns: value for `key` at sharding node, or None if the key doesn't exist.
-        """
-        node = self.get_node(key)
-        return node and node.get(key) or None
 
+def invalidate_tags(cache, *tags):
+    """Invalidate every entry tagged with `tags` in O(1) per tag.
 
-    def set(self, key, value, timeout=None):
-        """Set the value for key.
+    The generation counter of each tag is bumped, which changes the
+    cache keys of tagged entries; stale entries simply expire.
 
-        Args:
-            key: md5-based cache key.
-            value: value to be set.
-            timeout: expire the value in a given period (seconds).
-        """
-        node = self.get_node(key)
-        node.set(key, value, isinstance(timeout, int) and timeout or None)
+    Args:
+        cache: `AbstractCache` holding the generation counters.
+        tags: tags (e.g. 'user:42') or namespaces (e.g. 'product:*').
 
+    Returns: `Future` for non-blocking backends, None otherwise.
+    """
+    keys = ['gen:%s' % tag for tag in tags]
+    _generations.delete(*keys)
+    results = [cache.incr(key) for key in keys]
+    futures = [result for result in results if is_future(result)]
+    return futures and gen.multi(futures) or None
 
-    def delete(self, *keys):
-        """Delete cached items with given keys.
 
-        Args:
-            keys: single cache key or list of cache keys.
-        """
-        if isinstance(keys, (tuple, list)):
-            for key in keys:
-                node = self.get_node(key)
-                node.delete(key)
-        else:
-            node = self.get_node(key)
-            node.delete(key)
+# generation counters of tags cached by this process, see `CacheMixin.cache_tags_ttl`.
+_generations = LocalCache(max_entries=10000)
+# in-flight computations of this process: cache key -> `Future` of the cached data.
+_flights = {}
+# cache keys being refreshed in background by this process.
+_refreshing = set()
+
+
+class _RefreshConnection(object):
+    """Connection of background refresh requests, the response is discarded."""
+
+    def set_close_callback(self, callback):
+        pass
+
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        return self.write(chunk, callback)
+
+
+    def write(self, chunk, callback=None):
+        future = Future()
+        future.set_result(None)
+        if callback is not None:
+            IOLoop.current().add_callback(callback)
+        return future
+
+
+    def finish(self):
+        pass
+
 
 
 class CacheMixin(object):
     """Cache support for `tornado.web.RequestHandler`.
+
+    Works with both blocking (`RedisCache`) and non-blocking (`AsyncRedisCache`)
+    backends, results of the latter are awaited without blocking the IOLoop.
+
+    Concurrent misses of the same key are coalesced (single-flight): the first
+    request computes the response while the others wait for it. Set
+    `cache_lock_timeout` (seconds) to coalesce across processes as well via a
+    short-lived lock in the cache (requires `AbstractCache.add`).
+
+    Responses past their soft TTL (see `cache(expires, stale)`) are served stale
+    while a single background request regenerates them on the IOLoop.
+
+    Entries tagged by `get_cache_tags()` are invalidated in bulk with
+    `invalidate_tags()`: tag generation counters are folded into the cache key,
+    and cached by every process for `cache_tags_ttl` seconds.
     """
+    cache_lock_timeout  = None
+    cache_lock_interval = 0.05
+    cache_tags_ttl      = 1
+    # bodies up to this size (bytes) are stored within the cache entry itself.
+    cache_inline_size   = 4096
+    # request components the cache key varies on, see `get_cache_key()`.
+    cache_vary = {
+        'args':        None,
+        'ignore_args': ('utm_*', 'gclid', 'fbclid'),
+        'headers':     (),
+        'cookies':     (),
+        'user':        False,
+        'locale':      True,
+    }
+    # response headers replayed on cache hits.
+    cached_headers = ('Content-Type', 'Content-Language', 'Content-Disposition',
+                      'Cache-Control', 'Expires', 'Last-Modified', 'Location', 'Vary')
+
     @property
     def cache(self):
         return self.application.cache
@@ -179,31 +272,299 @@ class CacheMixin(object):
     def get_cache_key(self, namespace=None):
         """Generate unique cache key from the incoming request.
 
+        The key is computed once per request (and namespace).
+
         Key components by order:
             namespace: prepare for user identity based caching (None by default).
             user's locale (default: en_US).
-            full request url.
+            request path & normalized query arguments.
+            headers, cookies & user identity, see `cache_vary`.
         """
+        keys = getattr(self, '_cache_keys', None)
+        if keys is None:
+            keys = self._cache_keys = {}
+        if namespace not in keys:
+            keys[namespace] = self._cache_key(namespace)
+        return keys[namespace]
+
+
+    def _cache_key(self, namespace):
+        vary    = self.cache_vary
         secret  = ''.join((self.request.protocol, '://', self.request.host))
-        locale  = self.get_user_locale() or self.get_browser_locale()
-        context = [locale.code, self.request.full_url()]
+        context = [self.request.path, self.get_cache_query()]
+        if vary.get('locale', True):
+            locale = self.get_user_locale() or self.get_browser_locale()
+            context.insert(0, locale.code)
+        for name in vary.get('headers', ()):
+            context.append(self.request.headers.get(name, ''))
+        for name in vary.get('cookies', ()):
+            context.append(self.get_cookie(name, ''))
+        if vary.get('user'):
+            context.append(compat.UnicodeType(self.current_user or ''))
+        if getattr(self, '_cache_generations', None):
+            context.append(self._cache_generations)
         if namespace:
             context.insert(0, namespace)
-        return hmac.new(secret, '|'.join(context), hashlib.sha1).hexdigest()
+        message = escape.utf8(u'|'.join(escape.to_unicode(part) for part in context))
+        return self._cache_tag(hmac.new(escape.utf8(secret), message, hashlib.sha1).hexdigest())
+
+
+    def _cache_tag(self, key):
+        tag = self.get_cache_key_tag()
+        return tag and '{%s}%s' % (tag, key) or key
+
+
+    def get_cache_key_tag(self):
+        """Hash tag prefixed to the cache keys, e.g. 'user:42' -> '{user:42}<hmac>'.
+
+        Keys sharing a tag are stored on the same node (see `tornext.sharding.hash_tag`),
+        so related entries can be read & written in a single batch.
+        """
+        return None
+
 
+    def get_cache_tags(self):
+        """Tags of the response for bulk invalidation, e.g. ['user:42', 'product:7'].
 
+        Evaluated before the cache lookup, so only request data is available.
+        """
+        return ()
+
+
+    @gen.coroutine
+    def _cache_load_generations(self, tags):
+        """Fold the generation counters of `tags` into the cache key."""
+        keys   = ['gen:%s' % tag for tag in expand_tags(tags)]
+        values = [_generations.get(key) for key in keys]
+        missing = [index for index, value in enumerate(values) if value is None]
+        if missing:
+            fetched = yield gen.maybe_future(self.cache.get_many([keys[index] for index in missing]))
+            for index, value in zip(missing, fetched):
+                values[index] = int(value or 0)
+                _generations.set(keys[index], values[index], self.cache_tags_ttl)
+        self._cache_generations = ','.join('%s=%d' % pair for pair in zip(keys, values))
+        self._cache_keys = None
+
+
+    def invalidate_tags(self, *tags):
+        """Invalidate cached responses tagged with `tags`, see `tornext.cache.invalidate_tags`."""
+        return invalidate_tags(self.cache, *tags)
+
+
+    def get_cache_query(self):
+        """Normalize query arguments for the cache key.
+
+        Arguments are sorted by name and filtered by `cache_vary['args']`
+        (None for all) & `cache_vary['ignore_args']` (shell-style patterns),
+        so URLs differing only in argument order or tracking arguments share entries.
+        """
+        vary    = self.cache_vary
+        allowed = vary.get('args')
+        ignored = vary.get('ignore_args', ())
+        pairs   = []
+        for name in sorted(self.request.query_arguments):
+            if allowed is not None and name not in allowed:
+                continue
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in ignored):
+                continue
+            pairs.extend((name, value) for value in self.request.query_arguments[name])
+        return compat.urlencode(pairs)
+
+
+    @gen.coroutine
     def prepare(self):
-        super(CacheMixin, self).prepare()
-        key = self.get_cache_key()
-        if self.cache.exists(key):
-            if self.request.method in self.cached_methods:
-                data = self.cache.get(key)
-                self.write(pickle.loads(data))
-                self.finish()
+        """Serve the cached response with a single lookup.
+
+        Entries carry status, `cached_headers`, ETag and (up to `cache_inline_size`)
+        the body, conditional requests are answered with 304 without reading
+        larger bodies, which are stored under their own key.
+
+        On a miss the written body is buffered by `write()` and
+        stored once the response is complete, see `finish()`.
+        """
+        yield gen.maybe_future(super(CacheMixin, self).prepare())
+        if self.request.method not in self.cached_methods:
+            return
+        tags = self.get_cache_tags()
+        if tags:
+            yield self._cache_load_generations(tags)
+        if getattr(self.request, 'cache_refresh', None):
+            self._cache_body = []
+            return
+        key   = self.get_cache_key()
+        entry = yield self._cache_lookup(key)
+        if entry is None:
+            entry = yield self._cache_coalesce(key)
+        if entry is None:
+            self._cache_body = []
+            return
+        if entry['fresh_until'] is not None and entry['fresh_until'] < time.time():
+            self._cache_refresh(key)
+
+        self.set_status(entry['status'])
+        for name in set(name for name, value in entry['headers']):
+            self.clear_header(name)
+        for name, value in entry['headers']:
+            self.add_header(name, value)
+        self.set_header('Etag', entry['etag'])
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        body = entry['body']
+        if body is None:
+            data = yield gen.maybe_future(self.cache.get(self._cache_tag('body:%s' % entry['digest'])))
+            if data is None:
+                # the body has been evicted, regenerate the response.
+                self.clear()
+                self._cache_body = []
+                return
+            body = self.cache.serializer.loads(data)
+        super(CacheMixin, self).write(body)
+        self.finish()
+
+
+    @gen.coroutine
+    def _cache_lookup(self, key):
+        """Returns: decoded cache entry for `key`, None on miss."""
+        data = yield gen.maybe_future(self.cache.get(key))
+        if data is None:
+            raise gen.Return(None)
+        try:
+            entry = self.cache.serializer.loads(data)
+        except Exception as e:
+            logger.warning('Ignoring undecodable cache entry %s: %r', key, e)
+            entry = None
+        raise gen.Return(entry)
+
+
+    def _cache_refresh(self, key):
+        """Regenerate the stale response of `key` in background.
+
+        The request is replayed through the application with a discarding
+        connection, its response is stored by `finish()` as usual.
+        """
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+        headers = HTTPHeaders(self.request.headers)
+        for name in ('If-None-Match', 'If-Modified-Since'):
+            headers.pop(name, None)
+        request = HTTPServerRequest(method=self.request.method, uri=self.request.uri,
+                                    version=self.request.version, headers=headers,
+                                    host=self.request.host, connection=_RefreshConnection())
+        request.protocol  = self.request.protocol
+        request.remote_ip = self.request.remote_ip
+        request.cache_refresh = key
+        IOLoop.current().add_callback(self.application, request)
+
+
+    @gen.coroutine
+    def _cache_coalesce(self, key):
+        """Wait for a concurrent computation of `key`, or become its leader.
+
+        Returns: cache entry (including the body) produced by another
+        request, None if this request has to compute the response itself.
+        """
+        flight = _flights.get(key)
+        if flight is not None:
+            entry = yield flight
+            raise gen.Return(entry)
+        self._cache_flight = _flights[key] = Future()
+        self._cache_flight_key = key
+        if not self.cache_lock_timeout:
+            raise gen.Return(None)
+
+        lock = 'lock:%s' % key
+        timeout  = int(math.ceil(self.cache_lock_timeout))
+        acquired = yield gen.maybe_future(self.cache.add(lock, b'1', timeout))
+        if acquired:
+            self._cache_lock = lock
+            raise gen.Return(None)
+        # another process is computing, poll for its result until the lock expires.
+        deadline = time.time() + self.cache_lock_timeout
+        while time.time() < deadline:
+            yield gen.sleep(self.cache_lock_interval)
+            entry = yield self._cache_lookup(key)
+            if entry is not None:
+                self._cache_release(entry)
+                raise gen.Return(entry)
+            # the lock holder gave up (uncacheable response, crash), take over.
+            acquired = yield gen.maybe_future(self.cache.add(lock, b'1', timeout))
+            if acquired:
+                self._cache_lock = lock
+                raise gen.Return(None)
+        raise gen.Return(None)
+
+
+    def _cache_release(self, entry=None):
+        """Hand `entry` (None if nothing was cached) to the coalesced requests."""
+        flight = getattr(self, '_cache_flight', None)
+        if flight is not None:
+            self._cache_flight = None
+            if _flights.get(self._cache_flight_key) is flight:
+                del _flights[self._cache_flight_key]
+            flight.set_result(entry)
+        lock = getattr(self, '_cache_lock', None)
+        if lock is not None:
+            self._cache_lock = None
+            _background(self.cache.delete(lock))
+
+
+    @property
+    def cached_status(self):
+        return 200,
 
 
     def write(self, chunk):
-        data = pickle.dumps(chunk)
-        key  = self.get_cache_key()
-        self.cache.set(key, data, getattr(self, 'expires', None))
         super(CacheMixin, self).write(chunk)
+        body = getattr(self, '_cache_body', None)
+        if body is not None:
+            if isinstance(chunk, dict):
+                chunk = escape.json_encode(chunk)
+            body.append(escape.utf8(chunk))
+
+
+    def finish(self, chunk=None):
+        if chunk is not None:
+            self.write(chunk)
+        body = getattr(self, '_cache_body', None)
+        if body is not None and self.get_status() in self.cached_status:
+            self._cache_body = None
+            self._cache_store(b''.join(body))
+        return super(CacheMixin, self).finish()
+
+
+    def _cache_store(self, body):
+        """Store the complete response, see `prepare()` for the entry layout."""
+        expires = getattr(self, 'expires', None)
+        timeout = expires and expires + getattr(self, 'stale', 0) or None
+        digest  = hashlib.sha1(body).hexdigest()
+        etag    = self._headers.get('Etag')
+        if etag is None:
+            etag = '"%s"' % digest
+            self.set_header('Etag', etag)
+        entry   = {
+            'fresh_until': expires and time.time() + expires or None,
+            'status':  self.get_status(),
+            'headers': [(name, value) for name in self.cached_headers
+                                      for value in self._headers.get_list(name)],
+            'etag':   etag,
+            'digest': digest,
+            'body':   body if len(body) <= self.cache_inline_size else None,
+        }
+        serializer = self.cache.serializer
+        items = {self.get_cache_key(): serializer.dumps(entry)}
+        if entry['body'] is None:
+            items[self._cache_tag('body:%s' % digest)] = serializer.dumps(body)
+        _background(self.cache.set_many(items, timeout))
+        entry['body'] = body
+        self._cache_release(entry)
+
+
+    def on_finish(self):
+        self._cache_release()
+        _refreshing.discard(getattr(self.request, 'cache_refresh', None))
+        super(CacheMixin, self).on_finish()
+
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+"""
+In-process cache backends.
+
+`LocalCache` bounded LRU cache with per-entry TTL.
+
+`TieredCache` `LocalCache` (L1) in front of any shared `AbstractCache` (L2).
+"""
+import sys
+import time
+import logging
+import collections
+
+from tornado.util import ObjectDict
+
+from tornext import compat
+from tornext.cache import AbstractCache, chain
+
+
+__all__ = ('LocalCache', 'TieredCache')
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache(AbstractCache):
+    """Least-recently-used cache living in the current process.
+
+    Entries are evicted once either `max_entries` or `max_bytes` is exceeded,
+    expired entries are dropped lazily on access.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None):
+        """
+        Args:
+            max_entries: maximum number of cached entries.
+            max_bytes: maximum total size of cached values (None for unbounded).
+
+        Attributes:
+            entries (OrderedDict): key -> (value, expiry timestamp, size) by recency.
+            size (int): total size of cached values in bytes.
+        """
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size    = 0
+        self.hits    = 0
+        self.misses  = 0
+        self.timer   = time.time
+
+
+    def sizeof(self, value):
+        """Size of `value` accounted against `max_bytes`."""
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        return sys.getsizeof(value)
+
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= self.timer():
+            self._remove(key)
+            return None
+        return entry
+
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+    def get(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        # move to the most recently used end.
+        del self.entries[key]
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+
+    def set(self, key, value, timeout=None):
+        """Set the value for key.
+
+        Args:
+            key: cache key.
+            value: value to be set, values larger than `max_bytes` are not cached.
+            timeout: expire the value in a given period (seconds).
+        """
+        self._remove(key)
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = timeout and (self.timer() + timeout) or None
+        self.entries[key] = (value, expires, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or \
+              (self.max_bytes is not None and self.size > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry[2]
+
+
+    def add(self, key, value, timeout=None):
+        if self._lookup(key) is not None:
+            return False
+        self.set(key, value, timeout)
+        return True
+
+
+    def incr(self, key, delta=1):
+        entry = self._lookup(key)
+        value = (entry and int(entry[0]) or 0) + delta
+        self.set(key, value)
+        return value
+
+
+    def delete(self, *keys):
+        for key in keys:
+            self._remove(key)
+
+
+    def exists(self, key):
+        return self._lookup(key) is not None
+
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+class TieredCache(AbstractCache):
+    """Two-tier cache: hot keys are served from a `LocalCache` (L1)
+    without touching the network, misses fall through to `backend` (L2).
+
+    L1 entries live at most `max_staleness` seconds, which bounds how long
+    a process may serve a value after it was changed/deleted by another process.
+
+    L1 hits are returned as plain values even for non-blocking backends,
+    wrap results with `tornado.gen.maybe_future` (as `CacheMixin` does).
+    """
+    def __init__(self, backend, max_staleness=5, local=None, **settings):
+        """
+        Args:
+            backend: shared `AbstractCache` instance, e.g. `tornext.cache.redis.RedisCache`.
+            max_staleness: maximum lifetime (seconds) of L1 entries.
+            local: `LocalCache` instance, created from `settings` if omitted.
+            settings: `LocalCache` settings (`max_entries`, `max_bytes`).
+        """
+        self.backend = backend
+        self.local   = local or LocalCache(**settings)
+        self.max_staleness = max_staleness
+        self.l2_hits   = 0
+        self.l2_misses = 0
+
+
+    @property
+    def serializer(self):
+        return self.backend.serializer
+
+
+    @property
+    def blocking(self):
+        return self.backend.blocking
+
+
+    @property
+    def stats(self):
+        """Hit/miss counters per tier."""
+        return ObjectDict(
+            l1=ObjectDict(hits=self.local.hits, misses=self.local.misses),
+            l2=ObjectDict(hits=self.l2_hits, misses=self.l2_misses),
+        )
+
+
+    def _local_timeout(self, timeout):
+        if isinstance(timeout, int) and timeout > 0:
+            return min(timeout, self.max_staleness)
+        return self.max_staleness
+
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        def fill(value):
+            if value is None:
+                self.l2_misses += 1
+            else:
+                self.l2_hits += 1
+                self.local.set(key, value, self.max_staleness)
+            return value
+        return chain(self.backend.get(key), fill)
+
+
+    def set(self, key, value, timeout=None):
+        self.local.set(key, value, self._local_timeout(timeout))
+        return self.backend.set(key, value, timeout)
+
+
+    def add(self, key, value, timeout=None):
+        return self.backend.add(key, value, timeout)
+
+
+    def incr(self, key, delta=1):
+        self.local.delete(key)
+        return self.backend.incr(key, delta)
+
+
+    def delete(self, *keys):
+        self.local.delete(*keys)
+        return self.backend.delete(*keys)
+
+
+    def exists(self, key):
+        if self.local.exists(key):
+            return True
+        return self.backend.exists(key)
+
+
+    def get_many(self, keys):
+        """Get cached items, only L1 misses are fetched from the backend."""
+        results = [self.local.get(key) for key in keys]
+        missing = [index for index, value in enumerate(results) if value is None]
+        if not missing:
+            return results
+
+        def fill(values):
+            for index, value in zip(missing, values):
+                if value is None:
+                    self.l2_misses += 1
+                else:
+                    self.l2_hits += 1
+                    self.local.set(keys[index], value, self.max_staleness)
+                    results[index] = value
+            return results
+        return chain(self.backend.get_many([keys[index] for index in missing]), fill)
+
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in compat.iteritems(mapping):
+            self.local.set(key, value, self._local_timeout(timeout))
+        return self.backend.set_many(mapping, timeout)
+
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        self.local.delete(*keys)
+        return self.backend.delete_many(keys)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Non-blocking Redis protocol (RESP) client driven by Tornado's IOLoop.
+
+Only the small command set used by `tornext.cache` is wrapped explicitly,
+everything else is reachable via `AsyncRedis.execute_command`.
+"""
+from __future__ import absolute_import
+
+import socket
+import logging
+import datetime
+import collections
+
+from tornado import gen
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpclient import TCPClient
+from tornado.concurrent import Future
+
+from tornext import compat
+
+
+__all__ = ('RedisError', 'ConnectionError', 'ReplyError',
+           'Connection', 'ConnectionPool', 'AsyncRedis')
+
+
+logger = logging.getLogger(__name__)
+
+
+CRLF = b'\r\n'
+
+
+class RedisError(Exception):
+    pass
+
+
+class ConnectionError(RedisError):
+    pass
+
+
+class ReplyError(RedisError):
+    pass
+
+
+def encode(value):
+    """Encode single command argument into bytes."""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, compat.UnicodeType):
+        return value.encode('utf-8')
+    return compat.Byte(str(value))
+
+
+def pack_command(*args):
+    """Pack the given command arguments into RESP multi-bulk request."""
+    output = [compat.Byte('*%d\r\n' % len(args))]
+    for arg in args:
+        arg = encode(arg)
+        output.append(compat.Byte('$%d\r\n' % len(arg)))
+        output.append(arg)
+        output.append(CRLF)
+    return b''.join(output)
+
+
+def parse_url(url, **settings):
+    """Parse `redis://[:password@]host[:port][/db]` or `unix://path[?db=n]`
+    into `Connection` settings, explicit `settings` take precedence.
+    """
+    result = compat.urlparse(url)
+    params = dict((k, v[0]) for k, v in compat.iteritems(compat.parse_qs(result.query)))
+    kwargs = {'password': result.password, 'db': int(params.get('db', 0))}
+    if result.scheme == 'unix':
+        kwargs['unix_socket_path'] = result.path
+    else:
+        kwargs['host'] = result.hostname or 'localhost'
+        kwargs['port'] = int(result.port or 6379)
+        if result.path.strip('/'):
+            kwargs['db'] = int(result.path.strip('/'))
+    kwargs.update(settings)
+    return kwargs
+
+
+class Connection(object):
+    """Single non-blocking connection to a Redis server.
+
+    Commands are written & read in order, callers are expected to hold
+    the connection exclusively (see `ConnectionPool`) until the replies arrive.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 socket_timeout=None, socket_connect_timeout=None,
+                 unix_socket_path=None, **kwargs):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout or socket_timeout
+        self.unix_socket_path = unix_socket_path
+        self.stream = None
+
+
+    @property
+    def connected(self):
+        return self.stream is not None and not self.stream.closed()
+
+
+    def _timeout(self, future, seconds):
+        if not seconds:
+            return future
+        return gen.with_timeout(datetime.timedelta(seconds=seconds), future,
+                                quiet_exceptions=(StreamClosedError,))
+
+
+    @gen.coroutine
+    def connect(self):
+        if self.connected:
+            return
+        try:
+            if self.unix_socket_path:
+                stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+                future = stream.connect(self.unix_socket_path)
+            else:
+                future = TCPClient().connect(self.host, self.port)
+            self.stream = yield self._timeout(future, self.socket_connect_timeout)
+        except (StreamClosedError, gen.TimeoutError, socket.error) as e:
+            raise ConnectionError('Error connecting to %s: %r' % (self, e))
+        try:
+            if self.password:
+                yield self.execute('AUTH', self.password)
+            if self.db:
+                yield self.execute('SELECT', self.db)
+        except RedisError as e:
+            # never leave an unauthenticated connection (or one on db 0) behind.
+            self.disconnect()
+            raise ConnectionError('Error initializing %s: %r' % (self, e))
+
+
+    def disconnect(self):
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = None
+
+
+    @gen.coroutine
+    def execute(self, *args):
+        """Send single command and return its reply.
+
+        Raises: `ReplyError` if Redis replied with an error.
+        """
+        replies = yield self.pipeline([args])
+        if isinstance(replies[0], ReplyError):
+            raise replies[0]
+        raise gen.Return(replies[0])
+
+
+    @gen.coroutine
+    def pipeline(self, commands):
+        """Send all `commands` in one write and read back their replies.
+
+        Args:
+            commands: list of command argument tuples.
+
+        Returns: list of replies by order, error replies are returned as `ReplyError`.
+        """
+        yield self.connect()
+        try:
+            self.stream.write(b''.join(pack_command(*args) for args in commands))
+            replies = []
+            for _ in commands:
+                reply = yield self._timeout(self.read_reply(), self.socket_timeout)
+                replies.append(reply)
+        except (StreamClosedError, gen.TimeoutError, socket.error) as e:
+            # the stream is in an unknown state now, start over next time.
+            self.disconnect()
+            raise ConnectionError('Error communicating with %s: %r' % (self, e))
+        raise gen.Return(replies)
+
+
+    @gen.coroutine
+    def read_reply(self):
+        line = yield self.stream.read_until(CRLF)
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            raise gen.Return(payload)
+        if prefix == b'-':
+            raise gen.Return(ReplyError(payload.decode('utf-8', 'replace')))
+        if prefix == b':':
+            raise gen.Return(int(payload))
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                raise gen.Return(None)
+            data = yield self.stream.read_bytes(length + 2)
+            raise gen.Return(data[:-2])
+        if prefix == b'*':
+            length = int(payload)
+            if length < 0:
+                raise gen.Return(None)
+            items = []
+            for _ in compat.xrange(length):
+                item = yield self.read_reply()
+                items.append(item)
+            raise gen.Return(items)
+        self.disconnect()
+        raise ConnectionError('Protocol error, unexpected reply: %r' % line)
+
+
+    def __repr__(self):
+        if self.unix_socket_path:
+            return '<Connection unix://%s/%s>' % (self.unix_socket_path, self.db)
+        return '<Connection %s:%s/%s>' % (self.host, self.port, self.db)
+
+
+
+class ConnectionPool(object):
+    """Bounded pool of `Connection`, callers wait for a released
+    connection once `max_connections` is reached.
+    """
+    def __init__(self, max_connections=None, connection_class=Connection, **settings):
+        self.max_connections = max_connections
+        self.connection_class = connection_class
+        self.settings = settings
+        self.created = 0
+        self.idle = collections.deque()
+        self.waiters = collections.deque()
+
+
+    @classmethod
+    def from_url(cls, url, **settings):
+        return cls(**parse_url(url, **settings))
+
+
+    def acquire(self):
+        """Returns: `Future` resolving to an exclusive `Connection`."""
+        future = Future()
+        if self.idle:
+            future.set_result(self.idle.pop())
+        elif self.max_connections is None or self.created < self.max_connections:
+            self.created += 1
+            future.set_result(self.connection_class(**self.settings))
+        else:
+            self.waiters.append(future)
+        return future
+
+
+    def release(self, connection):
+        if self.waiters:
+            self.waiters.popleft().set_result(connection)
+        else:
+            self.idle.append(connection)
+
+
+    def disconnect(self):
+        for connection in self.idle:
+            connection.disconnect()
+
+
+
+class AsyncRedis(object):
+    """Non-blocking counterpart of `redis.client.StrictRedis`,
+    every command returns a `tornado.concurrent.Future`.
+    """
+    def __init__(self, connection_pool=None, **settings):
+        self.connection_pool = connection_pool or ConnectionPool(**settings)
+
+
+    @classmethod
+    def from_url(cls, url, **settings):
+        return cls(connection_pool=ConnectionPool.from_url(url, **settings))
+
+
+    @gen.coroutine
+    def execute_command(self, *args):
+        connection = yield self.connection_pool.acquire()
+        try:
+            reply = yield connection.execute(*args)
+        finally:
+            self.connection_pool.release(connection)
+        raise gen.Return(reply)
+
+
+    @gen.coroutine
+    def pipeline(self, commands):
+        """Execute `commands` in a single round-trip.
+
+        Returns: list of replies, error replies are returned as `ReplyError`.
+        """
+        connection = yield self.connection_pool.acquire()
+        try:
+            replies = yield connection.pipeline(commands)
+        finally:
+            self.connection_pool.release(connection)
+        raise gen.Return(replies)
+
+
+    def ping(self):
+        return self.execute_command('PING')
+
+
+    def get(self, name):
+        return self.execute_command('GET', name)
+
+
+    def mget(self, names):
+        return self.execute_command('MGET', *names)
+
+
+    def set(self, name, value, ex=None, nx=False):
+        args = ['SET', name, value]
+        if ex:
+            args += ['EX', ex]
+        if nx:
+            args.append('NX')
+        return self.execute_command(*args)
+
+
+    def incr(self, name, amount=1):
+        return self.execute_command('INCRBY', name, amount)
+
+
+    @gen.coroutine
+    def exists(self, name):
+        reply = yield self.execute_command('EXISTS', name)
+        raise gen.Return(bool(reply))
+
+
+    def delete(self, *names):
+        return self.execute_command('DEL', *names)
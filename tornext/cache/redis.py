@@ -16,26 +16,138 @@
 # limitations under the License.
 from __future__ import absolute_import
 """
+Sharded Redis cache backends.
 
+`RedisCache` blocking backend built on `redis.client.Redis`.
+
+`AsyncRedisCache` non-blocking backend built on `tornext.cache.protocol.AsyncRedis`.
+
+Both track the health of every node: a node failing `failure_threshold`
+times in a row is skipped (its keys fall over to the next node of the ring)
+until a background probe re-admits it, cache outages degrade to misses.
+
+Hot keys (see `HotKeys`) are copied to the next nodes of the ring and their
+reads are spread across these replicas.
 """
+import time
+import random
 import logging
+import collections
 
+from redis import exceptions
 from redis.client import Redis
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
 
+from tornext import compat
 from tornext.sharding import Sharding
-from tornext.cache import AbstractCache
+from tornext.cache import AbstractCache, chain
+from tornext.cache import protocol
+from tornext.cache.local import LocalCache
+from tornext.cache.protocol import AsyncRedis
 
 
 logger = logging.getLogger(__name__)
 
 
+class CircuitBreaker(object):
+    """Health of single node.
+
+    The breaker opens after `threshold` consecutive failures, an open breaker
+    lets one trial request through every `retry_interval` seconds (half-open)
+    and closes again on the first success.
+    """
+    def __init__(self, threshold=2, retry_interval=5):
+        self.threshold = threshold
+        self.retry_interval = retry_interval
+        self.failures  = 0
+        self.opened_at = None
+        self.timer = time.time
+
+
+    @property
+    def healthy(self):
+        return self.opened_at is None
+
+
+    def allow(self):
+        """Returns: boolean value indicating if a request may be sent to the node."""
+        if self.opened_at is None:
+            return True
+        now = self.timer()
+        if now - self.opened_at >= self.retry_interval:
+            self.opened_at = now
+            return True
+        return False
+
+
+    def success(self):
+        self.failures  = 0
+        self.opened_at = None
+
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = self.timer()
+
+
+
+class HotKeys(object):
+    """Sampling detector of frequently read keys.
+
+    One in `1 / sample_rate` reads is counted, a key read about `threshold`
+    times within `window` seconds is considered hot for the next `ttl` seconds.
+    """
+    def __init__(self, threshold=1000, window=1, sample_rate=0.01, ttl=10, max_keys=1024):
+        """
+        Args:
+            threshold: reads per `window` making a key hot.
+            window: length (seconds) of the counting window.
+            sample_rate: fraction of reads being counted.
+            ttl: seconds a key stays hot, also the lifetime of its replicas.
+            max_keys: maximum number of tracked hot keys.
+        """
+        self.threshold   = max(threshold * sample_rate, 1)
+        self.window      = window
+        self.sample_rate = sample_rate
+        self.ttl         = ttl
+        self.keys    = LocalCache(max_entries=max_keys)
+        self.counts  = collections.Counter()
+        self.started = 0
+        self.timer   = time.time
+        self.random  = random.random
+
+
+    def sample(self, key):
+        """Count a read of `key`.
+
+        Returns: boolean value indicating if `key` is hot.
+        """
+        if self.random() < self.sample_rate:
+            now = self.timer()
+            if now - self.started >= self.window:
+                self.counts.clear()
+                self.started = now
+            self.counts[key] += 1
+            if self.counts[key] >= self.threshold:
+                self.keys.set(key, True, self.ttl)
+                return True
+        return key in self
+
+
+    def __contains__(self, key):
+        return self.keys.exists(key)
+
+
+
 class RedisCache(AbstractCache):
     """
     Default sharding settings for single node (direct settings for `redis.client.StrictRedis`).
     {
         'host': 'localhost', 'port': 6379,
-        'db': 0, 'password': None, 'socket_timeout': None,
-        'socket_connect_timeout': None,
+        'db': 0, 'password': None, 'socket_timeout': 0.1,
+        'socket_connect_timeout': 0.05,
         'socket_keepalive': None, 'socket_keepalive_options': None,
         'connection_pool': None, 'unix_socket_path': None,
         'encoding': 'utf-8', 'encoding_errors': 'strict',
@@ -46,18 +158,92 @@ class RedisCache(AbstractCache):
     }
 
     """
-    def __init__(self, urls, **settings):
+    client_class = Redis
+
+    # sharding strategy, see `tornext.sharding`.
+    sharding_class = Sharding
+
+    # errors marking a node as failed, anything else is raised to the caller.
+    errors = (exceptions.ConnectionError, exceptions.TimeoutError)
+
+    # fast-fail timeouts (seconds), a cache miss is cheaper than a stalled request.
+    timeouts = {'socket_timeout': 0.1, 'socket_connect_timeout': 0.05}
+
+    def __init__(self, urls, failure_threshold=2, retry_interval=5, probe_interval=1,
+                 hot_replicas=2, hot_keys=None, **settings):
         """
         Args:
-            urls: list of connection urls for `redis.client.StrictRedis#from_url`.
+            urls: list of connection urls for `redis.client.StrictRedis#from_url`,
+                  or a `{url: weight}` dict for heterogeneous nodes.
+            failure_threshold: consecutive failures before a node is taken out of rotation.
+            retry_interval: seconds between trial requests to a failed node.
+            probe_interval: seconds between background probes of failed nodes.
+            hot_replicas: number of additional nodes holding hot keys (0 to disable).
+            hot_keys: `HotKeys` detector, created with the default settings if omitted.
             settings: additional settings for redis client.
 
         Attributes:
             mapping (dict): maintain the connection url & corresponding Redis client mapping.
-            sharding: `tornext.sharding.Sharding` instance for dispatching requests.
+            health (dict): maintain the connection url & corresponding `CircuitBreaker` mapping.
+            sharding: `sharding_class` instance for dispatching requests.
+        """
+        settings = dict(self.timeouts, **settings)
+        self.sharding = self.sharding_class(urls)
+        self.mapping  = dict([(url, self.client_class.from_url(url, **settings)) for url in urls])
+        self.health   = dict([(url, CircuitBreaker(failure_threshold, retry_interval)) for url in urls])
+        self.probe_interval = probe_interval
+        self.prober = None
+        self.hot_replicas = hot_replicas
+        self.hot = hot_keys or HotKeys()
+
+
+    def route(self, key):
+        """Get the url of the first live node for the given key.
+
+        Returns: connection url, or None if all nodes are down.
+        """
+        url = self.sharding.get_node(key)
+        if url is None or self.health[url].allow():
+            return url
+        for url in self.sharding.iter_nodes(key):
+            if self.health[url].allow():
+                return url
+        return None
+
+
+    def owners(self, key):
+        """Get the urls of the live nodes holding `key`: its owner,
+        followed by `hot_replicas` replicas if `key` is hot.
         """
-        self.sharding = Sharding(urls)
-        self.mapping  = dict([(url, Redis.from_url(url)) for url in urls])
+        count = 1 + (key in self.hot and self.hot_replicas or 0)
+        urls  = []
+        for url in self.sharding.iter_nodes(key):
+            if self.health[url].allow():
+                urls.append(url)
+                if len(urls) == count:
+                    break
+        return urls
+
+
+    def replica_groups(self, keys):
+        """Group the replicas of hot `keys` by node.
+
+        Returns: list of (url, indexes) tuples, where indexes are the positions in `keys`.
+        """
+        groups = collections.defaultdict(list)
+        if self.hot_replicas:
+            for index, key in enumerate(keys):
+                if key in self.hot:
+                    for url in self.owners(key)[1:]:
+                        groups[url].append(index)
+        return list(compat.iteritems(groups))
+
+
+    def replica_timeout(self, timeout):
+        """Replicas expire after `HotKeys.ttl`, which bounds how long they may
+        serve a value after it was changed/deleted by a process that didn't know the key is hot.
+        """
+        return min(timeout or self.hot.ttl, self.hot.ttl)
 
 
     def get_node(self, key):
@@ -69,8 +255,100 @@ class RedisCache(AbstractCache):
         Returns:
             instance of `redis.client.Redis` for accessing single Redis node.
         """
-        url = self.sharding.get_node(key)
-        return self.mapping.get(url)
+        return self.mapping.get(self.route(key))
+
+
+    def group_keys(self, keys):
+        """Group `keys` by their sharding node, keys without live node are left out.
+
+        Returns: list of (url, indexes) tuples, where indexes are the positions in `keys`.
+        """
+        if all(breaker.healthy for breaker in self.health.values()):
+            _, groups = self.sharding.get_nodes(keys)
+            return list(compat.iteritems(groups))
+        groups = collections.defaultdict(list)
+        for index, key in enumerate(keys):
+            url = self.route(key)
+            if url is not None:
+                groups[url].append(index)
+        return list(compat.iteritems(groups))
+
+
+    def failed(self, url, error):
+        """Record a failed request to the node at `url`."""
+        breaker = self.health[url]
+        breaker.failure()
+        if not breaker.healthy:
+            logger.warning('Redis node %s is down: %r', url, error)
+        self.watch()
+
+
+    def watch(self):
+        """Start probing while any node is down, stop once all nodes are healthy."""
+        down = not all(breaker.healthy for breaker in self.health.values())
+        if down and self.prober is None:
+            self.prober = PeriodicCallback(self.probe, self.probe_interval * 1000)
+            self.prober.start()
+        elif not down and self.prober is not None:
+            self.prober.stop()
+            self.prober = None
+
+
+    def execute(self, url, command, default=None):
+        """Run `command(client)` against the node at `url`.
+
+        Returns: result of `command`, or `default` if the node is (or went) down.
+        """
+        if url is None:
+            return default
+        try:
+            result = command(self.mapping[url])
+        except self.errors as e:
+            self.failed(url, e)
+            return default
+        self.health[url].success()
+        return result
+
+
+    def probe(self):
+        """Ping the failed nodes, recovered nodes are re-admitted."""
+        for url, breaker in list(compat.iteritems(self.health)):
+            if not breaker.healthy:
+                self.execute(url, lambda node: node.ping())
+        self.watch()
+
+
+    def gather(self, results):
+        """Wait for the results of per-node commands (already done for blocking clients)."""
+        return results
+
+
+    def node_get_many(self, url, keys):
+        return self.execute(url, lambda node: node.mget(keys), [None] * len(keys))
+
+
+    def node_set_many(self, url, items, timeout=None):
+        def command(node):
+            pipeline = node.pipeline(transaction=False)
+            for key, value in items:
+                pipeline.set(key, value, timeout)
+            return pipeline.execute()
+        return self.execute(url, command)
+
+
+    def node_delete(self, url, keys):
+        return self.execute(url, lambda node: node.delete(*keys))
+
+
+    def get_replica(self, key, urls):
+        """Read hot `key` from a random replica, replica misses are refilled from the owner."""
+        url   = random.choice(urls)
+        value = self.execute(url, lambda node: node.get(key))
+        if value is None and url != urls[0]:
+            value = self.execute(urls[0], lambda node: node.get(key))
+            if value is not None:
+                self.execute(url, lambda node: node.set(key, value, self.hot.ttl))
+        return value
 
 
     def exists(self, key):
@@ -81,8 +359,7 @@ class RedisCache(AbstractCache):
 
         Returns: boolean value indicating if corresponding `key` exists.
         """
-        node = self.get_node(key)
-        return node and node.exists(key) or False
+        return chain(self.execute(self.route(key), lambda node: node.exists(key), False), bool)
 
 
     def get(self, key):
@@ -95,8 +372,11 @@ class RedisCache(AbstractCache):
 
         Returns: value for `key` at sharding node, or None if the key doesn't exist.
         """
-        node = self.get_node(key)
-        return node and node.get(key) or None
+        if self.hot_replicas and self.hot.sample(key):
+            urls = self.owners(key)
+            if len(urls) > 1:
+                return self.get_replica(key, urls)
+        return self.execute(self.route(key), lambda node: node.get(key))
 
 
     def set(self, key, value, timeout=None):
@@ -107,8 +387,31 @@ class RedisCache(AbstractCache):
             value: value to be set.
             timeout: expire the value in a given period (seconds).
         """
-        node = self.get_node(key)
-        node.set(key, value, isinstance(timeout, int) and timeout or None)
+        timeout = isinstance(timeout, int) and timeout or None
+        if self.hot_replicas and key in self.hot:
+            return self.set_many({key: value}, timeout)
+        return self.execute(self.route(key), lambda node: node.set(key, value, timeout))
+
+
+    def add(self, key, value, timeout=None):
+        """Set the value for key only if it doesn't exist yet (SET NX).
+
+        Returns: boolean value indicating if the value was set.
+        """
+        timeout = isinstance(timeout, int) and timeout or None
+        return chain(self.execute(self.route(key),
+                                  lambda node: node.set(key, value, timeout, nx=True), False), bool)
+
+
+    def incr(self, key, delta=1):
+        """Increment the integer value of key (INCRBY).
+
+        Returns: value after the increment, None if the node is down.
+        """
+        replicas = self.replica_groups([key])
+        if replicas:
+            self.gather([self.node_delete(url, [key]) for url, _ in replicas])
+        return self.execute(self.route(key), lambda node: node.incr(key, delta))
 
 
     def delete(self, *keys):
@@ -117,12 +420,114 @@ class RedisCache(AbstractCache):
         Args:
             keys: single cache key or list of cache keys.
         """
-        if isinstance(keys, (tuple, list)):
-            for key in keys:
-                node = self.get_node(key)
-                node.delete(key)
+        return self.delete_many(keys)
+
+
+    def get_many(self, keys):
+        """Get cached items with one MGET per sharding node.
+
+        Returns: list of values (None for missing keys) in the order of `keys`.
+        """
+        groups = self.group_keys(keys)
+
+        def assemble(replies):
+            results = [None] * len(keys)
+            for (url, indexes), values in zip(groups, replies):
+                for index, value in zip(indexes, values):
+                    results[index] = value
+            return results
+        return chain(self.gather([self.node_get_many(url, [keys[index] for index in indexes])
+                                  for url, indexes in groups]), assemble)
+
+
+    def set_many(self, mapping, timeout=None):
+        """Set key/value pairs with one pipelined batch per sharding node,
+        hot keys are written to their replicas as well.
+
+        Args:
+            mapping: dict of key/value pairs.
+            timeout: expire the values in a given period (seconds).
+        """
+        timeout = isinstance(timeout, int) and timeout or None
+        keys = list(mapping)
+        results = [self.node_set_many(url, [(keys[index], mapping[keys[index]]) for index in indexes], timeout)
+                   for url, indexes in self.group_keys(keys)]
+        results += [self.node_set_many(url, [(keys[index], mapping[keys[index]]) for index in indexes],
+                                       self.replica_timeout(timeout))
+                    for url, indexes in self.replica_groups(keys)]
+        return self.gather(results)
+
+
+    def delete_many(self, keys):
+        """Delete cached items with one DEL per sharding node (and replica of hot keys)."""
+        keys = list(keys)
+        return self.gather([self.node_delete(url, [keys[index] for index in indexes])
+                            for url, indexes in self.group_keys(keys) + self.replica_groups(keys)])
+
+
+
+class AsyncRedisCache(RedisCache):
+    """Non-blocking `RedisCache`, commands are sent through Tornado's IOLoop
+    so a slow Redis node never stalls other requests on the same worker.
+
+    Every method returns a `tornado.concurrent.Future`, settings are passed
+    to `tornext.cache.protocol.ConnectionPool` (e.g. `max_connections`,
+    `socket_timeout`, `socket_connect_timeout`).
+    """
+    client_class = AsyncRedis
+
+    blocking = False
+
+    errors = (protocol.ConnectionError,)
+
+    @gen.coroutine
+    def execute(self, url, command, default=None):
+        if url is None:
+            raise gen.Return(default)
+        try:
+            result = yield command(self.mapping[url])
+        except self.errors as e:
+            self.failed(url, e)
+            raise gen.Return(default)
+        self.health[url].success()
+        raise gen.Return(result)
+
+
+    @gen.coroutine
+    def probe(self):
+        yield [self.execute(url, lambda node: node.ping())
+               for url, breaker in compat.iteritems(self.health) if not breaker.healthy]
+        self.watch()
+
+
+    def gather(self, results):
+        """Per-node commands run concurrently."""
+        return gen.multi(results)
+
+
+    def node_set_many(self, url, items, timeout=None):
+        if timeout:
+            commands = [('SET', key, value, 'EX', timeout) for key, value in items]
         else:
-            node = self.get_node(key)
-            node.delete(key)
+            commands = [sum([[key, value] for key, value in items], ['MSET'])]
+
+        @gen.coroutine
+        def command(node):
+            replies = yield node.pipeline(commands)
+            # raise the first error reply, like the blocking pipeline does.
+            for reply in replies:
+                if isinstance(reply, protocol.ReplyError):
+                    raise reply
+            raise gen.Return(replies)
+        return self.execute(url, command)
 
 
+    @gen.coroutine
+    def get_replica(self, key, urls):
+        url   = random.choice(urls)
+        value = yield self.execute(url, lambda node: node.get(key))
+        if value is None and url != urls[0]:
+            value = yield self.execute(urls[0], lambda node: node.get(key))
+            if value is not None:
+                yield self.execute(url, lambda node: node.set(key, value, self.hot.ttl))
+        raise gen.Return(value)
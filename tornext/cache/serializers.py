@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+"""
+Serializers for cached values.
+
+Every serialized value starts with a header byte: the low nibble identifies
+the format, the high nibble the compression. Values written with different
+settings can therefore be read by any `Serializer` during a rollout.
+
+Formats:
+    raw         bytes passthrough (always used for bytes values).
+    pickle      any picklable object.
+    marshal     compact binary format for builtin types.
+    msgpack     compact binary format, requires `msgpack`.
+
+Compressions: zlib, lz4 (requires `lz4`).
+"""
+import zlib
+import marshal
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+from tornext import compat
+
+
+__all__ = ('Serializer', 'FORMATS', 'COMPRESSIONS')
+
+
+FORMATS      = {'raw': 0, 'pickle': 1, 'marshal': 2, 'msgpack': 3}
+COMPRESSIONS = {None: 0, 'zlib': 1, 'lz4': 2}
+
+# first byte of pickle protocol 2+ data written by header-less versions,
+# protocol 0/1 pickles start with an opcode (>= 0x28) which is no valid header.
+PICKLE_PROTO = 0x80
+
+
+ENCODERS = {
+    FORMATS['raw']:     lambda value: value,
+    FORMATS['pickle']:  lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+    FORMATS['marshal']: marshal.dumps,
+    FORMATS['msgpack']: msgpack and (lambda value: msgpack.packb(value, use_bin_type=True)),
+}
+
+DECODERS = {
+    FORMATS['raw']:     lambda data: data,
+    FORMATS['pickle']:  pickle.loads,
+    FORMATS['marshal']: marshal.loads,
+    FORMATS['msgpack']: msgpack and (lambda data: msgpack.unpackb(data, raw=False)),
+}
+
+COMPRESSORS = {
+    COMPRESSIONS['zlib']: zlib.compress,
+    COMPRESSIONS['lz4']:  lz4 and lz4.compress,
+}
+
+DECOMPRESSORS = {
+    COMPRESSIONS['zlib']: zlib.decompress,
+    COMPRESSIONS['lz4']:  lz4 and lz4.decompress,
+}
+
+
+class Serializer(object):
+    """Encode values for `AbstractCache` backends.
+
+    Example:
+        cache.serializer = Serializer(format='msgpack', compress='zlib', threshold=512)
+    """
+    def __init__(self, format='pickle', compress='zlib', threshold=1024):
+        """
+        Args:
+            format: format for non-bytes values (see `FORMATS`).
+            compress: compression for values larger than `threshold` (None to disable).
+            threshold: minimum size (bytes) of encoded values to be compressed.
+        """
+        if format not in FORMATS or not ENCODERS[FORMATS[format]]:
+            raise ValueError('Unsupported serializer format: %r' % format)
+        if compress not in COMPRESSIONS or (compress and not COMPRESSORS[COMPRESSIONS[compress]]):
+            raise ValueError('Unsupported serializer compression: %r' % compress)
+        self.format    = FORMATS[format]
+        self.compress  = COMPRESSIONS[compress]
+        self.threshold = threshold
+
+
+    def dumps(self, value):
+        """Returns: header byte followed by the encoded (compressed) value."""
+        if isinstance(value, bytes):
+            format, data = FORMATS['raw'], value
+        else:
+            format, data = self.format, ENCODERS[self.format](value)
+        compression = 0
+        if self.compress and len(data) >= self.threshold:
+            compressed = COMPRESSORS[self.compress](data)
+            if len(compressed) < len(data):
+                compression, data = self.compress, compressed
+        return compat.Byte(chr(format | compression << 4)) + data
+
+
+    def loads(self, data):
+        """Decode `data` written by any `Serializer` (or plain pickle of any protocol)."""
+        header = compat.ByteIndex(data, 0)
+        decode     = DECODERS.get(header & 0x0f)
+        decompress = DECOMPRESSORS.get(header >> 4)
+        if header == PICKLE_PROTO or not decode or (header >> 4 and not decompress):
+            try:
+                return pickle.loads(data)
+            except Exception:
+                raise ValueError('Unsupported serializer header: %#x' % header)
+        data = data[1:]
+        if decompress:
+            data = decompress(data)
+        return decode(data)
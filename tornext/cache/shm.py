@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+"""
+Shared-memory cache backend for pre-forked workers on one host.
+
+The cache lives in anonymous shared memory maps created before forking,
+every worker process forked afterwards reads & writes the same copy.
+"""
+import mmap
+import time
+import zlib
+import struct
+import logging
+import multiprocessing
+
+from tornext import compat
+from tornext.cache import AbstractCache
+from tornext.cache.protocol import encode
+
+
+__all__ = ('SlotTable', 'SharedMemoryCache')
+
+
+logger = logging.getLogger(__name__)
+
+
+# slot header: key length, value length, expiry timestamp (0 for never).
+HEADER = struct.Struct('<HId')
+
+
+class SlotTable(object):
+    """Fixed-slot hash table in shared memory.
+
+    Keys hash to a bucket of `ways` consecutive slots, each bucket is guarded
+    by one of `stripes` locks. Expired slots are reused first, a full bucket
+    evicts the entry closest to expiry.
+    """
+    def __init__(self, slots, slot_size, ways, stripes, max_key_size):
+        if slot_size <= HEADER.size + max_key_size:
+            raise ValueError('slot_size must exceed %d bytes' % (HEADER.size + max_key_size))
+        self.slot_size    = slot_size
+        self.ways         = ways
+        self.buckets      = max(slots // ways, 1)
+        self.max_key_size = max_key_size
+        self.max_value_size = slot_size - HEADER.size - max_key_size
+        self.memory = mmap.mmap(-1, self.buckets * ways * slot_size)
+        self.locks  = [multiprocessing.Lock() for _ in compat.xrange(stripes)]
+
+
+    def bucket(self, key):
+        """Returns: (lock, slot offsets) of the bucket for `key`."""
+        bucket = (zlib.crc32(key) & 0xffffffff) % self.buckets
+        start  = bucket * self.ways * self.slot_size
+        return (self.locks[bucket % len(self.locks)],
+                range(start, start + self.ways * self.slot_size, self.slot_size))
+
+
+    def find(self, key, offsets, now):
+        """Returns: offset of the live slot holding `key`, None if missing."""
+        for offset in offsets:
+            keylen, valuelen, expires = HEADER.unpack_from(self.memory, offset)
+            if keylen != len(key):
+                continue
+            start = offset + HEADER.size
+            if self.memory[start:start + keylen] != key:
+                continue
+            if expires and expires <= now:
+                return None
+            return offset
+        return None
+
+
+    def read(self, offset):
+        keylen, valuelen, expires = HEADER.unpack_from(self.memory, offset)
+        start = offset + HEADER.size + self.max_key_size
+        return self.memory[start:start + valuelen]
+
+
+    def write(self, key, value, timeout, offsets, now):
+        """Write into the slot of `key`, a free/expired slot or the one closest to expiry."""
+        target, victim = None, None
+        for offset in offsets:
+            keylen, valuelen, expires = HEADER.unpack_from(self.memory, offset)
+            start = offset + HEADER.size
+            if keylen == len(key) and self.memory[start:start + keylen] == key:
+                target = offset
+                break
+            if target is None and (not keylen or (expires and expires <= now)):
+                target = offset
+            if victim is None or (expires or float('inf')) < victim[1]:
+                victim = (offset, expires or float('inf'))
+        offset = target if target is not None else victim[0]
+        expires = timeout and now + timeout or 0
+        HEADER.pack_into(self.memory, offset, len(key), len(value), expires)
+        start = offset + HEADER.size
+        self.memory[start:start + len(key)] = key
+        start = offset + HEADER.size + self.max_key_size
+        self.memory[start:start + len(value)] = value
+
+
+    def clear(self, offset):
+        HEADER.pack_into(self.memory, offset, 0, 0, 0)
+
+
+    def close(self):
+        self.memory.close()
+
+
+
+class SharedMemoryCache(AbstractCache):
+    """Shared memory cache made of `SlotTable` size classes.
+
+    Values live in the table with the smallest slots they fit in: `slots` of
+    `slot_size` bytes, then the `size_classes` for larger values (e.g. pages
+    cached by `CacheMixin`). Values exceeding the largest slots are not cached.
+
+    Example:
+        app.cache = SharedMemoryCache(slots=65536, slot_size=1024,
+                                      size_classes=((4096, 16384), (256, 262144)))
+        server.start(num_processes=0)   # fork after creating the cache.
+    """
+    def __init__(self, slots=65536, slot_size=1024, ways=4, stripes=64, max_key_size=250,
+                 size_classes=((2048, 16384), (128, 262144))):
+        """
+        Args:
+            slots: total number of slots for small values.
+            slot_size: size (bytes) of each slot, including header & key.
+            ways: number of slots per bucket.
+            stripes: number of locks shared by the buckets of each table.
+            max_key_size: maximum size (bytes) of keys.
+            size_classes: (slots, slot_size) of the tables for larger values.
+        """
+        classes = [(slots, slot_size)] + sorted(size_classes, key=lambda size_class: size_class[1])
+        self.tables = [SlotTable(count, size, ways, stripes, max_key_size) for count, size in classes]
+        self.max_key_size   = max_key_size
+        self.max_value_size = self.tables[-1].max_value_size
+        self.timer = time.time
+
+
+    def _encode(self, key, value=None):
+        key = encode(key)
+        if len(key) > self.max_key_size:
+            raise ValueError('Key exceeds %d bytes: %r' % (self.max_key_size, key))
+        if value is not None:
+            value = encode(value)
+        return key, value
+
+
+    def _table(self, value):
+        """Returns: the table with the smallest slots fitting `value`, None if too large."""
+        for table in self.tables:
+            if len(value) <= table.max_value_size:
+                return table
+        return None
+
+
+    def _exists(self, key, tables):
+        for table in tables:
+            lock, offsets = table.bucket(key)
+            with lock:
+                if table.find(key, offsets, self.timer()) is not None:
+                    return True
+        return False
+
+
+    def _discard(self, key, keep=None):
+        """Remove `key` from every table but `keep`."""
+        for table in self.tables:
+            if table is keep:
+                continue
+            lock, offsets = table.bucket(key)
+            with lock:
+                offset = table.find(key, offsets, self.timer())
+                if offset is not None:
+                    table.clear(offset)
+
+
+    def get(self, key):
+        key, _ = self._encode(key)
+        for table in self.tables:
+            lock, offsets = table.bucket(key)
+            with lock:
+                offset = table.find(key, offsets, self.timer())
+                if offset is not None:
+                    return table.read(offset)
+        return None
+
+
+    def set(self, key, value, timeout=None):
+        """Set the value for key.
+
+        Args:
+            key: cache key.
+            value: bytes (or string/number) value.
+            timeout: expire the value in a given period (seconds).
+
+        Returns: boolean value indicating if the value was cached.
+        """
+        key, value = self._encode(key, value)
+        table = self._table(value)
+        if table is None:
+            logger.warning('Value of %r exceeds %d bytes, not cached', key, self.max_value_size)
+            self._discard(key)
+            return False
+        lock, offsets = table.bucket(key)
+        with lock:
+            table.write(key, value, timeout, offsets, self.timer())
+        # drop the previous value held by another size class.
+        self._discard(key, keep=table)
+        return True
+
+
+    def add(self, key, value, timeout=None):
+        key, value = self._encode(key, value)
+        table = self._table(value)
+        if table is None or self._exists(key, [other for other in self.tables if other is not table]):
+            return False
+        lock, offsets = table.bucket(key)
+        with lock:
+            now = self.timer()
+            if table.find(key, offsets, now) is not None:
+                return False
+            table.write(key, value, timeout, offsets, now)
+            return True
+
+
+    def incr(self, key, delta=1):
+        key, _ = self._encode(key)
+        # counters always fit the smallest slots.
+        table = self.tables[0]
+        lock, offsets = table.bucket(key)
+        with lock:
+            now    = self.timer()
+            offset = table.find(key, offsets, now)
+            value  = (offset is not None and int(table.read(offset)) or 0) + delta
+            expires = offset is not None and HEADER.unpack_from(table.memory, offset)[2] or 0
+            table.write(key, encode(value), expires and expires - now, offsets, now)
+        self._discard(key, keep=table)
+        return value
+
+
+    def delete(self, *keys):
+        for key in keys:
+            key, _ = self._encode(key)
+            self._discard(key)
+
+
+    def exists(self, key):
+        key, _ = self._encode(key)
+        return self._exists(key, self.tables)
+
+
+    def close(self):
+        for table in self.tables:
+            table.close()
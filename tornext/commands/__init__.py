@@ -21,7 +21,9 @@ Options:
     -h, --help          show this help message and exit.
 
 Commands:
+    benchmark           compare the sharding strategies of `tornext.sharding`.
     create              create a Tornado project with the given name.
+    rebalance           copy the keys moving between two sets of Redis nodes.
     test                run test suite for Tornext.
 
 See 'tornext <command> --help' for further information on a specific command.
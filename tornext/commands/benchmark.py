@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Usage: tornext benchmark [options]
+
+Compare distribution, key movement and throughput of the sharding strategies.
+
+Options:
+    -h, --help              show this help message and exit.
+    -n, --nodes=<n>         comma separated node counts [default: 3,10,50].
+    -k, --keys=<n>          number of keys per run [default: 100000].
+
+See 'tornext help <command>' for more information on a specific command.
+"""
+from __future__ import absolute_import, print_function
+
+import math
+import time
+
+from docopt import docopt
+
+from tornext.sharding import Sharding, KetamaSharding, JumpSharding, RendezvousSharding
+
+
+STRATEGIES = (
+    ('crc32', Sharding),
+    ('ketama', KetamaSharding),
+    ('jump', JumpSharding),
+    ('rendezvous', RendezvousSharding),
+)
+
+
+def distribution(nodes, counts):
+    """Returns: (stddev, max) of the per-node loads relative to the mean, in percent."""
+    loads = [counts.get(node, 0) for node in nodes]
+    mean  = float(sum(loads)) / len(loads)
+    stddev = math.sqrt(sum((load - mean) ** 2 for load in loads) / len(loads))
+    return 100 * stddev / mean, 100 * max(loads) / mean
+
+
+def run(name, factory, count, keys):
+    nodes = ['redis://10.0.%d.%d:6379' % (x // 256, x % 256) for x in range(count)]
+
+    started  = time.time()
+    sharding = factory(nodes)
+    build    = time.time() - started
+
+    started = time.time()
+    owners  = [sharding.get_node(key) for key in keys]
+    single  = len(keys) / (time.time() - started)
+
+    started = time.time()
+    _, groups = sharding.get_nodes(keys)
+    batch   = len(keys) / (time.time() - started)
+
+    stddev, peak = distribution(nodes, dict((node, len(indexes)) for node, indexes in groups.items()))
+
+    sharding.add_node('redis://10.1.0.0:6379')
+    moved = sum(owner != sharding.get_node(key) for owner, key in zip(owners, keys))
+
+    print('%-12s %6d %9.1f %8.1f%% %8.1f%% %7.1f%% %7.1f%% %12d %12d' % (
+        name, count, build * 1000, stddev, peak,
+        100.0 * moved / len(keys), 100.0 / (count + 1), single, batch))
+
+
+def execute(args):
+    keys = ['key:%d' % x for x in range(int(args['--keys']))]
+    print('%-12s %6s %9s %9s %9s %8s %8s %12s %12s' % (
+        'strategy', 'nodes', 'build/ms', 'stddev', 'max', 'moved', 'ideal', 'get_node/s', 'get_nodes/s'))
+    for count in [int(n) for n in args['--nodes'].split(',')]:
+        for name, factory in STRATEGIES:
+            run(name, factory, count, keys)
+
+
+if __name__ == '__main__':
+    execute(docopt(__doc__))
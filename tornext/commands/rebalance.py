@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Usage: tornext rebalance --from=<urls> --to=<urls> [options]
+
+Copy the keys changing their owner between two sets of Redis nodes, run it
+before switching `RedisCache` to the new nodes so that no key turns into a miss.
+
+Keys are read with SCAN from the nodes losing hash ranges and copied with
+DUMP/RESTORE (TTL preserved) to their new owners in pipelined batches.
+
+Nodes of weighted rings (`RedisCache({url: weight})`) are given as `url=weight`.
+
+Options:
+    -h, --help              show this help message and exit.
+    --from=<urls>           comma separated urls (or url=weight) of the current nodes.
+    --to=<urls>             comma separated urls (or url=weight) of the new nodes.
+    --strategy=<name>       sharding strategy: crc32, ketama or rendezvous [default: crc32].
+    --replicas=<n>          virtual points per node of crc32/ketama rings (strategy default if omitted).
+    --batch=<n>             keys per SCAN & pipelined batch [default: 500].
+    --rate=<n>              maximum keys copied per second, 0 for unlimited [default: 5000].
+    --delete                delete copied keys from their old owners.
+    --dry-run               only report the moving hash ranges.
+
+See 'tornext help <command>' for more information on a specific command.
+"""
+from __future__ import absolute_import, print_function
+
+import time
+
+from docopt import docopt
+from redis.client import Redis
+
+from tornext.sharding import Sharding, KetamaSharding, RendezvousSharding
+
+
+STRATEGIES = {
+    'crc32': Sharding,
+    'ketama': KetamaSharding,
+    'rendezvous': RendezvousSharding,
+}
+
+
+class Throttle(object):
+    """Limit the throughput to `rate` items per second."""
+
+    def __init__(self, rate):
+        self.rate    = rate
+        self.started = time.time()
+        self.count   = 0
+
+
+    def __call__(self, count):
+        self.count += count
+        if self.rate:
+            delay = self.started + float(self.count) / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+
+def parse_nodes(value):
+    """Parse comma separated `url` or `url=weight` items.
+
+    Returns: list of urls, or a `{url: weight}` dict if any weight is given.
+    """
+    nodes = []
+    for item in value.split(','):
+        if not item:
+            continue
+        url, _, weight = item.rpartition('=')
+        # the last '=' may belong to the query of the url (e.g. `?db=1`).
+        query = url.partition('?')[2]
+        try:
+            weight = float(weight)
+        except ValueError:
+            url, weight = item, None
+        else:
+            if not url or (query and '=' not in query):
+                url, weight = item, None
+        nodes.append((url, weight))
+    if all(weight is None for _, weight in nodes):
+        return [url for url, _ in nodes]
+    return dict((url, 1 if weight is None else weight) for url, weight in nodes)
+
+
+def create_sharding(args, urls):
+    """Returns: sharding of the `urls` nodes, as configured by `args`."""
+    factory = STRATEGIES[args['--strategy']]
+    if args.get('--replicas'):
+        if not issubclass(factory, Sharding):
+            raise SystemExit('--replicas only applies to crc32/ketama rings.')
+        return factory(parse_nodes(urls), replicas=int(args['--replicas']))
+    return factory(parse_nodes(urls))
+
+
+def sources(old, new):
+    """Nodes of `old` losing keys to `new`, every node for strategies without ranges."""
+    if isinstance(old, Sharding):
+        moves = old.diff(new)
+        print('%d ranges (%.2f%% of the hash space) change their owner.' % (
+            len(moves), 100.0 * sum(move.stop - move.start for move in moves) / (1 << 32)))
+        for move in moves:
+            print('  [%10d, %10d) %s -> %s' % move)
+        return sorted(set(move.source for move in moves))
+    return sorted(old.nodes)
+
+
+def migrate(source, old, new, clients, args, throttle):
+    """Copy the keys of `source` moving to other nodes.
+
+    Returns: number of copied keys.
+    """
+    client, cursor, copied = clients[source], 0, 0
+    while True:
+        cursor, keys = client.scan(cursor, count=int(args['--batch']))
+        # replicas & failover copies stay where they are.
+        keys = [key for key in keys if old.get_node(key) == source]
+        _, groups = new.get_nodes(keys)
+        for target, indexes in groups.items():
+            if target == source:
+                continue
+            batch = [keys[index] for index in indexes]
+            pipeline = client.pipeline(transaction=False)
+            for key in batch:
+                pipeline.pttl(key)
+                pipeline.dump(key)
+            replies = pipeline.execute()
+            pipeline = clients[target].pipeline(transaction=False)
+            moved = []
+            for key, ttl, data in zip(batch, replies[::2], replies[1::2]):
+                # expired (or deleted) since SCAN.
+                if data is None or ttl == -2:
+                    continue
+                pipeline.restore(key, max(ttl, 0), data, replace=True)
+                moved.append(key)
+            pipeline.execute()
+            if args['--delete'] and moved:
+                client.delete(*moved)
+            copied += len(moved)
+            throttle(len(moved))
+        if not int(cursor):
+            return copied
+
+
+def execute(args):
+    old = create_sharding(args, args['--from'])
+    new = create_sharding(args, args['--to'])
+    nodes = sources(old, new)
+    if args['--dry-run']:
+        return
+    clients  = dict((url, Redis.from_url(url)) for url in old.nodes | new.nodes)
+    throttle = Throttle(int(args['--rate']))
+    for source in nodes:
+        print('%s: %d keys copied.' % (source, migrate(source, old, new, clients, args, throttle)))
+
+
+if __name__ == '__main__':
+    execute(docopt(__doc__))
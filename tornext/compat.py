@@ -30,6 +30,11 @@ IsPy3   = (sys.version_info.major == 3)
 #==========================================================================================
 #   Imports
 #==========================================================================================
+if IsPy3:
+    from urllib.parse import urlparse, parse_qs, urlencode
+else:
+    from urlparse import urlparse, parse_qs
+    from urllib import urlencode
 
 
 #==========================================================================================
@@ -38,6 +43,7 @@ IsPy3   = (sys.version_info.major == 3)
 UnicodeType = IsPy3 and str or getattr(types, 'UnicodeType')
 StringType  = IsPy3 and str or getattr(types, 'StringTypes')
 RegexType   = type(re.compile(r'RegexType'))
+IntegerTypes = IsPy3 and (int,) or (int, getattr(types, 'LongType'))
 
 
 #==========================================================================================
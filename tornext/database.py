@@ -14,27 +14,268 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from uuid import uuid4
-from urlparse import urlparse
+import os
+import math
+import time
+import zlib
+import random
+import socket
+import string
+import logging
+import binascii
+import itertools
+import threading
+import collections
 
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, text
+from sqlalchemy.types import TypeDecorator, BigInteger, LargeBinary
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.engine.url import make_url
+from tornado import gen
+from tornado.concurrent import Future, chain_future
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from tornext import compat
+from tornext.sharding import Sharding
 
 """
 General SQLAlchemy helpers for easy scaling.
 
-`ObjectId` uuid4-based object id for sharding (32-bit).
+`ObjectId` k-sortable 128-bit object id (32 hex characters), e.g. for sharding.
+
+`ObjectIdGenerator` k-sortable 64/128-bit ids with base32/base62/binary encodings.
+
+`ObjectIdType` SQLAlchemy column type storing ids in their compact binary form.
 
 `create_session_factory` SQLAlchemy Session Class maker.
 
+`create_async_session_factory` maker of `AsyncSession`, non-blocking session facade.
+
+`ShardRouter` routes ids/shard keys to the database server owning them.
+
+`ReplicaSet` routes read-only sessions to replicas & writes to the primary.
+
+`DatabaseMixin` per-request `AsyncSession` for `tornado.web.RequestHandler`.
+
 `get_host_from_uri` fetch host (port) from database URI as sharding key.
 """
 
 
-__all__ = ('ObjectId', 'create_session_factory', 'get_host_from_uri',)
+__all__ = ('ObjectId', 'ObjectIdGenerator', 'ObjectIdType', 'encode_id', 'decode_id',
+           'create_session_factory', 'create_async_session_factory',
+           'AsyncSession', 'AsyncSessionFactory', 'ShardRouter', 'ReplicaSet',
+           'DatabaseMixin', 'get_host_from_uri',)
+
+
+logger = logging.getLogger(__name__)
+
+
+# bit widths of (timestamp, worker, counter, random) fields by id size.
+Layout  = collections.namedtuple('Layout', ('time', 'worker', 'counter', 'random'))
+LAYOUTS = {64: Layout(41, 10, 12, 0), 128: Layout(48, 16, 16, 48)}
+
+# 2014-01-01 UTC (milliseconds), epoch of 64-bit ids: 41 bits last till 2083.
+EPOCH = 1388534400000
+
+# both alphabets are in ASCII order, fixed-width texts sort like the ids.
+ALPHABETS = {
+    'base32': '0123456789ABCDEFGHJKMNPQRSTVWXYZ',
+    'base62': string.digits + string.ascii_uppercase + string.ascii_lowercase,
+}
+
+
+def encode_id(value, encoding='base62', bits=128):
+    """Encode integer id into fixed-width text (or bytes).
+
+    Args:
+        value: id generated by `ObjectIdGenerator`.
+        encoding: one of `hex`, `base32` (Crockford), `base62` or `bytes` (big-endian).
+        bits: size of the id.
+
+    Returns: encoded id, preserving the order of ids.
+    """
+    if encoding == 'hex':
+        return '%0*x' % (bits // 4, value)
+    if encoding == 'bytes':
+        return binascii.unhexlify(encode_id(value, 'hex', bits))
+    alphabet = ALPHABETS[encoding]
+    base  = len(alphabet)
+    chars = []
+    for _ in compat.xrange(int(math.ceil(bits / math.log(base, 2)))):
+        value, index = divmod(value, base)
+        chars.append(alphabet[index])
+    return ''.join(reversed(chars))
+
+
+def decode_id(data, encoding='base62'):
+    """Decode id encoded by `encode_id`.
+
+    Returns: integer id.
+    """
+    if encoding == 'hex':
+        return int(data, 16)
+    if encoding == 'bytes':
+        return int(binascii.hexlify(bytes(data)), 16)
+    if encoding == 'base32':
+        data = data.upper()
+    alphabet = ALPHABETS[encoding]
+    value = 0
+    for char in data:
+        index = alphabet.find(char)
+        if index < 0:
+            raise ValueError('Invalid %s id: %r' % (encoding, data))
+        value = value * len(alphabet) + index
+    return value
+
+
+
+class ObjectIdGenerator(object):
+    """K-sortable ids: millisecond timestamp, worker id & counter (most significant first).
+
+    Ids of one generator are strictly increasing, ids of different workers
+    are ordered by time, so inserts append to the right edge of B-tree indexes
+    instead of splitting random pages.
+
+    Layouts:
+        64-bit:  41-bit timestamp since `EPOCH`, 10-bit worker, 12-bit counter,
+                 fits signed BIGINT columns.
+        128-bit: 48-bit unix timestamp, 16-bit worker, 16-bit counter, 48 random bits.
+
+    Running out of counters within one millisecond (or the clock going backwards)
+    borrows the following millisecond rather than waiting.
+
+    Example:
+        ids = ObjectIdGenerator(bits=64, worker=3)
+        Column(ObjectIdType(bits=64), primary_key=True, default=ids)
+        session.add_all([Order(id=id) for id in ids.bulk(1000)])
+    """
+    def __init__(self, bits=128, worker=None, epoch=None):
+        """
+        Args:
+            bits: size of ids, either 64 or 128.
+            worker: worker id, derived from hostname & pid if omitted,
+                    give unique ones to the processes sharing 64-bit ids.
+            epoch: start (unix milliseconds) of timestamps, `EPOCH` for 64-bit ids.
+        """
+        if bits not in LAYOUTS:
+            raise ValueError('Unsupported id size: %r' % bits)
+        self.bits   = bits
+        self.layout = LAYOUTS[bits]
+        self.worker = worker
+        self.epoch  = epoch if epoch is not None else (bits == 64 and EPOCH or 0)
+        self.lock   = threading.Lock()
+        self.timer  = time.time
+        self.pid    = None
+
+
+    def _reset(self):
+        """(Re)start the sequence, once per process: forked workers must not
+        share the worker id (when derived) & the random state of their parent.
+        """
+        self.pid = os.getpid()
+        worker = self.worker
+        if worker is None:
+            worker = zlib.crc32(compat.Byte('%s:%d' % (socket.gethostname(), self.pid)))
+        self.worker_id = worker & ((1 << self.layout.worker) - 1)
+        self.random  = random.Random()
+        self.last    = 0
+        self.counter = 0
+
+
+    def _next(self):
+        layout = self.layout
+        if self.pid != os.getpid():
+            self._reset()
+        now = int(self.timer() * 1000) - self.epoch
+        if now > self.last:
+            self.last, self.counter = now, 0
+        else:
+            self.counter += 1
+            if self.counter >> layout.counter:
+                self.last, self.counter = self.last + 1, 0
+        value = ((self.last << layout.worker | self.worker_id) << layout.counter | self.counter) << layout.random
+        if layout.random:
+            value |= self.random.getrandbits(layout.random)
+        return value
+
+
+    def __call__(self):
+        """Returns: next id (int)."""
+        with self.lock:
+            return self._next()
+
+
+    def bulk(self, count):
+        """Returns: list of `count` consecutive ids, e.g. for batch inserts."""
+        with self.lock:
+            return [self._next() for _ in compat.xrange(count)]
+
+
+    def timestamp(self, value):
+        """Returns: unix timestamp (seconds) of id `value`."""
+        layout = self.layout
+        return ((value >> (layout.worker + layout.counter + layout.random)) + self.epoch) / 1000.0
+
+
+    def encode(self, value, encoding='base62'):
+        return encode_id(value, encoding, self.bits)
+
+
+
+class ObjectIdType(TypeDecorator):
+    """Column type of `ObjectIdGenerator` ids: BIGINT for 64-bit ids,
+    16-byte binary for 128-bit ids (half the size of their hex form).
+
+    Bound values are ints, bytes or text in `encoding` (hex if omitted),
+    results are ints, or text if `encoding` is given.
+    """
+    impl = LargeBinary
+    cache_ok = True
 
+    def __init__(self, bits=128, encoding=None):
+        if bits not in LAYOUTS:
+            raise ValueError('Unsupported id size: %r' % bits)
+        TypeDecorator.__init__(self)
+        self.bits     = bits
+        self.encoding = encoding
 
-ObjectId = lambda: uuid4().hex
+
+    def load_dialect_impl(self, dialect):
+        if self.bits == 64:
+            return dialect.type_descriptor(BigInteger())
+        return dialect.type_descriptor(LargeBinary(self.bits // 8))
+
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, (bytes, bytearray)) and len(value) == self.bits // 8:
+            value = decode_id(value, 'bytes')
+        elif not isinstance(value, compat.IntegerTypes):
+            value = decode_id(value, self.encoding or 'hex')
+        if self.bits == 64:
+            return value
+        return encode_id(value, 'bytes', self.bits)
+
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = self.bits == 64 and int(value) or decode_id(value, 'bytes')
+        if self.encoding:
+            return encode_id(value, self.encoding, self.bits)
+        return value
+
+
+
+generator = ObjectIdGenerator()
+
+
+def ObjectId():
+    """K-sortable 128-bit object id as 32 hex characters."""
+    return encode_id(generator(), 'hex')
 
 
 def create_session_factory(dburi, **options):
@@ -53,6 +294,476 @@ def create_session_factory(dburi, **options):
     return sessionmaker(bind=engine)
 
 
+def get_pool_size(engine):
+    """Maximum number of connections held by the pool of `engine` (5 if unbounded)."""
+    pool = engine.pool
+    if isinstance(pool, StaticPool):
+        return 1
+    size = getattr(pool, 'size', None)
+    # `SingletonThreadPool.size` is a plain attribute, not bounding anything.
+    if not callable(size):
+        return 5
+    return size() + max(getattr(pool, '_max_overflow', 0), 0)
+
+
+def create_async_session_factory(dburi, executor=None, **options):
+    """Create a factory of non-blocking sessions.
+
+    Args:
+        dburi: database URI for connection.
+        executor: `concurrent.futures.Executor` running the blocking work,
+                  a thread pool sized to the engine's connection pool if omitted.
+        options: options to connect.
+
+    Returns:
+        `AsyncSessionFactory` instance, call it for a new `AsyncSession`.
+    """
+    if dburi.startswith('sqlite'):
+        # one session hands its connection from one executor thread to the next.
+        connect_args = options.setdefault('connect_args', {})
+        connect_args.setdefault('check_same_thread', False)
+        if make_url(dburi).database in (None, '', ':memory:'):
+            # every connection would open its own empty in-memory database.
+            options['poolclass'] = StaticPool
+    engine = create_engine(dburi, **options)
+    executor = executor or ThreadPoolExecutor(max_workers=get_pool_size(engine))
+    return AsyncSessionFactory(sessionmaker(bind=engine), executor)
+
+
+
+class AsyncSessionFactory(object):
+    """Creates `AsyncSession` sharing one engine & executor.
+
+    Attributes:
+        outstanding (int): number of operations of its sessions in flight.
+    """
+    def __init__(self, factory, executor):
+        self.factory  = factory
+        self.executor = executor
+        self.outstanding = 0
+
+
+    @property
+    def engine(self):
+        return self.factory.kw['bind']
+
+
+    def route(self, key=None, readonly=False):
+        """Session factory for `key`, the same for every key without sharding."""
+        return self
+
+
+    def __call__(self, **kwargs):
+        return AsyncSession(self.factory(**kwargs), self.executor, self)
+
+
+
+class ShardRouter(object):
+    """Horizontal partitioning across database servers.
+
+    Every host of `urls` gets its own engine, connection pool & executor,
+    ids/shard keys are mapped onto the hosts via `sharding_class`.
+
+    Example:
+        app.database = ShardRouter(options.database['urls'],
+                                   pools={'db1.example.com:5432': {'pool_size': 20}})
+        session = app.database.route(user.id)()
+    """
+    sharding_class = Sharding
+
+    def __init__(self, urls, pools=None, replicas=None, executor=None, **options):
+        """
+        Args:
+            urls: list of database URIs (one per host), or a `{uri: weight}` dict.
+            pools: per-shard engine options (e.g. `pool_size`, `max_overflow`)
+                   keyed by URI or host, taking precedence over `options`.
+            replicas: per-shard list of replica URIs keyed by URI or host,
+                      these shards are served by a `ReplicaSet`.
+            executor: executor shared by all shards, one per shard (sized to its pool) if omitted.
+            options: engine options for all shards.
+
+        Attributes:
+            factories (dict): host -> `AsyncSessionFactory` mapping.
+            sharding: `sharding_class` instance mapping shard keys onto hosts.
+        """
+        pools   = pools or {}
+        replicas = replicas or {}
+        weights = isinstance(urls, dict) and urls or dict((url, 1) for url in urls)
+        self.factories = collections.OrderedDict()
+        for url in urls:
+            host = get_host_from_uri(url)
+            if host in self.factories:
+                raise ValueError('Duplicate database host: %s' % host)
+            settings = dict(options, **pools.get(url, pools.get(host, {})))
+            if url in replicas or host in replicas:
+                self.factories[host] = ReplicaSet(url, replicas.get(url, replicas.get(host)),
+                                                  executor=executor, **settings)
+            else:
+                self.factories[host] = create_async_session_factory(url, executor, **settings)
+        self.sharding = self.sharding_class(dict((get_host_from_uri(url), weight)
+                                                 for url, weight in compat.iteritems(weights)))
+
+
+    def get_host(self, key):
+        """Get the host owning `key` (e.g. an `ObjectId` or user id)."""
+        return self.sharding.get_node('%s' % key)
+
+
+    def route(self, key=None, readonly=False):
+        """Get the `AsyncSessionFactory` of the shard owning `key`."""
+        if key is None:
+            raise ValueError('ShardRouter requires a shard key')
+        return self.factories[self.get_host(key)].route(key, readonly)
+
+
+    def __call__(self, key, **kwargs):
+        """New `AsyncSession` of the shard owning `key`."""
+        return self.route(key)(**kwargs)
+
+
+
+def replication_lag(session):
+    """Replication lag (seconds) of the replica behind `session`.
+
+    Supports PostgreSQL & MySQL, other databases are reported without lag.
+
+    Returns: lag in seconds, None if replication is broken.
+    """
+    dialect = session.bind.dialect.name
+    if dialect == 'postgresql':
+        return session.scalar(text('SELECT COALESCE(EXTRACT(EPOCH FROM now() - '
+                                   'pg_last_xact_replay_timestamp()), 0)'))
+    if dialect == 'mysql':
+        status = session.execute(text('SHOW SLAVE STATUS')).first()
+        return status and status.Seconds_Behind_Master
+    return 0
+
+
+
+class ReplicaSet(object):
+    """Primary/replica routing.
+
+    Writes (and every session not flagged as read-only) go to the primary,
+    read-only sessions are spread across the replicas by `policy`:
+        round_robin         replicas in turn.
+        least_outstanding   replica with the fewest operations in flight.
+
+    With `max_lag` set, the lag of every replica is checked periodically and
+    replicas falling behind (or failing the check) leave the rotation until
+    they catch up; reads fall back to the primary if no replica is left.
+    A replica whose previous check is still running is not checked again (and
+    is out of rotation meanwhile).
+
+    Example:
+        app.database = ReplicaSet('postgresql://primary/app',
+                                  ['postgresql://replica1/app', 'postgresql://replica2/app'],
+                                  policy='least_outstanding', max_lag=2)
+    """
+    policies = ('round_robin', 'least_outstanding')
+
+    def __init__(self, primary, replicas=(), policy='round_robin', max_lag=None,
+                 check_interval=5, lag=replication_lag, executor=None, **options):
+        """
+        Args:
+            primary: database URI of the primary.
+            replicas: list of database URIs of the replicas.
+            policy: balancing policy for the replicas, see `policies`.
+            max_lag: maximum replication lag (seconds), None to skip the checks.
+            check_interval: seconds between two lag checks.
+            lag: function returning the lag (seconds) for a `sqlalchemy.orm.Session`.
+            executor: executor shared by all databases, one per database if omitted.
+            options: engine options for all databases.
+        """
+        if policy not in self.policies:
+            raise ValueError('Unsupported replica policy: %r' % policy)
+        self.primary  = create_async_session_factory(primary, executor, **options)
+        self.replicas = [create_async_session_factory(url, executor, **options) for url in replicas]
+        self.policy  = policy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag     = lag
+        self.lagging = set()
+        # replicas with a lag check in flight.
+        self.checking = set()
+        self.counter = itertools.count()
+        self.checker = None
+
+
+    @property
+    def engine(self):
+        return self.primary.engine
+
+
+    @property
+    def available(self):
+        """Replicas in rotation."""
+        return [factory for factory in self.replicas if factory not in self.lagging]
+
+
+    def route(self, key=None, readonly=False):
+        """Get the primary's `AsyncSessionFactory`, or a replica's for read-only sessions."""
+        if not readonly:
+            return self.primary
+        self.watch()
+        replicas = self.available
+        if not replicas:
+            return self.primary
+        if self.policy == 'least_outstanding':
+            return min(replicas, key=lambda factory: factory.outstanding)
+        return replicas[next(self.counter) % len(replicas)]
+
+
+    def watch(self):
+        """Start the periodic lag checks once replicas are used."""
+        if self.max_lag is not None and self.replicas and self.checker is None:
+            self.checker = PeriodicCallback(self.check, self.check_interval * 1000)
+            self.checker.start()
+
+
+    @gen.coroutine
+    def check(self):
+        """Check the lag of every replica, replicas beyond `max_lag` leave the rotation."""
+        yield [self._check(factory) for factory in self.replicas]
+
+
+    @gen.coroutine
+    def _check(self, factory):
+        if factory in self.checking:
+            # the replica hangs, don't pile up sessions on it.
+            if factory not in self.lagging:
+                logger.warning('Lag check of %s still running, removed from rotation',
+                               factory.engine.url)
+            self.lagging.add(factory)
+            return
+        self.checking.add(factory)
+        session = factory()
+        try:
+            lag = yield session.run(self.lag)
+        except Exception as e:
+            logger.warning('Lag check of %s failed: %r', factory.engine.url, e)
+            lag = None
+        self.checking.discard(factory)
+        IOLoop.current().add_future(session.close(), _log_failure)
+        if lag is None or lag > self.max_lag:
+            if factory not in self.lagging:
+                logger.warning('Replica %s is lagging (%s seconds), removed from rotation',
+                               factory.engine.url, lag)
+            self.lagging.add(factory)
+        elif factory in self.lagging:
+            logger.info('Replica %s caught up, back in rotation', factory.engine.url)
+            self.lagging.discard(factory)
+
+
+    def __call__(self, **kwargs):
+        """New `AsyncSession` of the primary."""
+        return self.primary(**kwargs)
+
+
+
+class AsyncSession(object):
+    """Non-blocking facade of `sqlalchemy.orm.Session`.
+
+    Everything touching the database (queries, flushes, commits) runs on
+    `executor` and returns a `tornado.concurrent.Future` resolved on the IOLoop,
+    the calls of one session are queued & executed one at a time by order,
+    a call waiting for its turn does not hold an executor thread.
+
+    Example:
+        session = factory()
+        users   = yield session.all(session.query(User).filter_by(active=True))
+        session.add(User(name='jim'))
+        yield session.commit()
+        yield session.close()
+    """
+    def __init__(self, session, executor, factory=None):
+        self.session  = session
+        self.executor = executor
+        self.factory  = factory
+        # last queued call, the next one is submitted once it is done.
+        self.tail = None
+        # whether changes were flushed/committed through this session.
+        self.written = False
+
+
+    def run(self, func, *args, **kwargs):
+        """Run `func(session, *args, **kwargs)` on the executor,
+        after the calls queued before (whether they succeeded or not).
+
+        Returns: `Future` resolving to the result of `func`.
+        """
+        future  = Future()
+        io_loop = IOLoop.current()
+        previous, self.tail = self.tail, future
+
+        def submit(_=None):
+            # resolve on the IOLoop, not on the executor thread finishing the work.
+            io_loop.add_future(self.executor.submit(func, self.session, *args, **kwargs),
+                               lambda done: chain_future(done, future))
+        if previous is None or previous.done():
+            submit()
+        else:
+            previous.add_done_callback(submit)
+        if self.factory is not None:
+            self.factory.outstanding += 1
+            future.add_done_callback(self._done)
+        return future
+
+
+    def _done(self, future):
+        self.factory.outstanding -= 1
+
+
+    def query(self, *entities, **kwargs):
+        """Build a `sqlalchemy.orm.Query` bound to this session, run it with `all()`, `first()`..."""
+        return self.session.query(*entities, **kwargs)
+
+
+    def all(self, query):
+        return self.run(lambda session: query.all())
+
+
+    def first(self, query):
+        return self.run(lambda session: query.first())
+
+
+    def one(self, query):
+        return self.run(lambda session: query.one())
+
+
+    def count(self, query):
+        return self.run(lambda session: query.count())
+
+
+    def get(self, entity, ident):
+        return self.run(lambda session: session.query(entity).get(ident))
+
+
+    def execute(self, statement, params=None):
+        """Execute `statement`.
+
+        Returns: `Future` resolving to the fetched rows, or the number
+                 of affected rows for statements without result rows.
+        """
+        def execute(session):
+            result = session.execute(statement, params)
+            if result.returns_rows:
+                return result.fetchall()
+            return result.rowcount
+        return self.run(execute)
+
+
+    def scalar(self, statement, params=None):
+        return self.run(lambda session: session.scalar(statement, params))
+
+
+    def add(self, instance):
+        """Add `instance` to the session, written with the next flush/commit.
+
+        Queued like every other call, no need to wait for the returned `Future`.
+        """
+        return self.run(lambda session: session.add(instance))
+
+
+    def add_all(self, instances):
+        return self.run(lambda session: session.add_all(instances))
+
+
+    def delete(self, instance):
+        return self.run(lambda session: session.delete(instance))
+
+
+    def merge(self, instance):
+        return self.run(lambda session: session.merge(instance))
+
+
+    def refresh(self, instance):
+        return self.run(lambda session: session.refresh(instance))
+
+
+    def flush(self):
+        self.written = True
+        return self.run(lambda session: session.flush())
+
+
+    def commit(self):
+        self.written = True
+        return self.run(lambda session: session.commit())
+
+
+    def rollback(self):
+        return self.run(lambda session: session.rollback())
+
+
+    def close(self):
+        """Roll back pending changes & return the connection to the pool."""
+        return self.run(lambda session: session.close())
+
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.warning('Closing database session failed: %r', future.exception())
+
+
+
+class DatabaseMixin(object):
+    """Database support for `tornado.web.RequestHandler`.
+
+    Sessions are created on first access from `application.database` (an
+    `AsyncSessionFactory`, `ReplicaSet` or `ShardRouter`), one per database
+    & request, and closed once the request finishes, uncommitted changes are rolled back.
+
+    Sessions of `database_readonly` handlers are served by replicas, except for
+    `database_sticky` seconds after the same client wrote to the primary
+    (tracked by a cookie), so clients always read their own writes.
+    """
+    database_readonly = False
+    database_sticky   = 5
+    database_cookie   = 'db_primary'
+
+    @property
+    def session(self):
+        return self.get_session()
+
+
+    def get_session(self, key=None, readonly=None):
+        """Get the session of the database owning `key` (required with `ShardRouter`).
+
+        Args:
+            key: shard key, e.g. an `ObjectId`.
+            readonly: route to a replica, `database_readonly` by default.
+        """
+        sessions = getattr(self, '_sessions', None)
+        if sessions is None:
+            sessions = self._sessions = {}
+        if readonly is None:
+            readonly = self.database_readonly
+        if readonly and self.database_sticky:
+            until = self.get_cookie(self.database_cookie)
+            readonly = not (until and until.isdigit() and int(until) > time.time()) and \
+                       not any(session.written for session in sessions.values())
+        factory = self.application.database.route(key, readonly)
+        if factory not in sessions:
+            sessions[factory] = factory()
+        return sessions[factory]
+
+
+    def finish(self, chunk=None):
+        sessions = getattr(self, '_sessions', None) or {}
+        if self.database_sticky and any(session.written for session in sessions.values()):
+            until = int(time.time() + self.database_sticky)
+            self.set_cookie(self.database_cookie, str(until), expires=until)
+        return super(DatabaseMixin, self).finish(chunk)
+
+
+    def on_finish(self):
+        sessions, self._sessions = getattr(self, '_sessions', None) or {}, None
+        for session in sessions.values():
+            IOLoop.current().add_future(session.close(), _log_failure)
+        super(DatabaseMixin, self).on_finish()
+
+
+
 def get_host_from_uri(dburi):
     """Get host (& port) from the given database URI.
 
@@ -65,7 +776,7 @@ def get_host_from_uri(dburi):
         ParseResult(scheme='postgresql', netloc='scott:tiger@localhost:5432', path='/mydatabase', params='', query='', fragment='')
         ParseResult(scheme='sqlite', netloc='', path='//absolute/path/to/foo.db', params='', query='', fragment='')
     """
-    result = urlparse(dburi)
+    result = compat.urlparse(dburi)
     # for file-based SQLite & extrame case that we can't find netloc.
     if result.scheme == 'sqlite' or not result.netloc:
         return dburi
@@ -75,4 +786,3 @@ def get_host_from_uri(dburi):
         return result.netloc.split('@')[-1]
 
     return result.netloc
-
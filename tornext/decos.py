@@ -17,8 +17,17 @@
 
 from __future__ import absolute_import
 
+import inspect
+import hashlib
 import logging
-from tornext import utils
+import functools
+
+from tornado import gen, escape
+from tornado.concurrent import is_future
+
+from tornext import compat
+from tornext.cache import chain, _background
+from tornext.cache.local import LocalCache
 
 """
 Consolidated decorators.
@@ -44,12 +53,137 @@ def decorate(wrapper):
     return lambda *args, **kwargs: lambda func: wrapper(func, *args, **kwargs)
 
 
+getargspec = getattr(inspect, 'getfullargspec', None) or getattr(inspect, 'getargspec')
+
+
+def _normalizer(func):
+    """Build a function mapping the call arguments of `func` into a sorted list
+    of (parameter, value) pairs, so positional, keyword & default arguments match.
+
+    Functions without introspectable signature fall back to (args, sorted kwargs).
+    """
+    while getattr(func, '__wrapped__', None) is not None:
+        func = func.__wrapped__
+    try:
+        spec = getargspec(func)
+    except TypeError:
+        spec = None
+
+    def normalize(args, kwargs, method=False):
+        try:
+            values = inspect.getcallargs(func, *args, **kwargs)
+        except TypeError:
+            # not introspectable (e.g. builtins), or an invalid call raising on its own.
+            return args[method and 1 or 0:], sorted(kwargs.items())
+        if method and spec[0]:
+            del values[spec[0][0]]
+        elif method:
+            values[spec[1]] = values[spec[1]][1:]
+        if spec[2]:
+            values[spec[2]] = sorted(values[spec[2]].items())
+        return sorted(values.items())
+    return normalize
+
+
+def _is_method(args, wrapper):
+    """Check if `wrapper` is called as a method of `args[0]`."""
+    attr = args and getattr(type(args[0]), wrapper.__name__, None)
+    return attr is not None and getattr(attr, compat._meth_func, attr) is wrapper
+
+
 @decorate
-def cache(func, timeout=3600):
-    def wrapper(self, *args, **kwargs):
-        #cache_key = utils.get_cache_key(self.request)
-        #logger.info('** Decorating: %s Timeout: %d' % (cache_key, timeout))
-        # cachding the calculated response here
+def cache(func, timeout=3600, local=0, backend=None, vary=None):
+    """Memoize the results of functions, methods & Tornado coroutines.
+
+    Results are keyed by the function's qualified name & normalized arguments
+    (which should have a stable `repr`) and stored in `backend`, the handler
+    application's `cache` for handler methods, or the in-process cache only.
+
+    Method keys leave `self` out, results are shared by every instance and must
+    depend on the explicit arguments only, unless `vary` adds the instance state
+    they depend on (e.g. the current user) to the key.
+
+    Example:
+        class ProductHandler(RequestHandler):
+            @cache(timeout=60, local=1000)
+            @gen.coroutine
+            def get_price(self, product_id, currency):
+                ...
+
+            @cache(timeout=60, vary=lambda self, *args: self.current_user)
+            @gen.coroutine
+            def get_discount(self, product_id):
+                ...
+
+    Args:
+        timeout: expire the results in a given period (seconds).
+        local: size of the in-process cache consulted before `backend` (0 to disable).
+        backend: `tornext.cache.AbstractCache` instance to store the results.
+        vary: callable invoked with the call arguments (`self` included), its
+              result (with a stable `repr`) is added to the key.
+
+    Coroutines always return `Future`. Plain functions always return plain values,
+    non-blocking backends are skipped for them (the in-process cache is used instead).
+    """
+    name = '.'.join((func.__module__, getattr(func, '__qualname__', func.__name__)))
+    memo = LocalCache(max_entries=local or 1024)
+    coroutine = getattr(func, '__tornado_coroutine__', False)
+    normalize = _normalizer(func)
+
+    def store(cache, key, result):
+        if local or cache is None:
+            memo.set(key, [result], timeout)
+        if cache is not None:
+            _background(cache.set(key, cache.serializer.dumps([result]), timeout))
+        return result
+
+    def compute(cache, key, args, kwargs):
+        result = func(*args, **kwargs)
+        if is_future(result):
+            return chain(result, lambda value: store(cache, key, value))
+        return store(cache, key, result)
+
+    @gen.coroutine
+    def resolve(cache, key, data, args, kwargs):
+        data = yield data
+        if data is not None:
+            entry = cache.serializer.loads(data)
+            if local:
+                memo.set(key, entry, timeout)
+            raise gen.Return(entry[0])
+        result = yield gen.maybe_future(func(*args, **kwargs))
+        raise gen.Return(store(cache, key, result))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        context, cache, method = name, backend, _is_method(args, wrapper)
+        if method:
+            context = '%s.%s' % (type(args[0]).__name__, name)
+            if cache is None:
+                cache = getattr(getattr(args[0], 'application', None), 'cache', None)
+        if cache is not None and not coroutine and not getattr(cache, 'blocking', True):
+            # plain functions can't wait for the backend.
+            cache = None
+        values = normalize(args, kwargs, method)
+        if vary is not None:
+            values = (values, vary(*args, **kwargs))
+        digest = hashlib.sha1(escape.utf8(repr(values))).hexdigest()
+        key    = 'memo:%s:%s' % (context, digest)
+
+        if local or cache is None:
+            entry = memo.get(key)
+            if entry is not None:
+                return coroutine and gen.maybe_future(entry[0]) or entry[0]
+            if cache is None:
+                return compute(None, key, args, kwargs)
 
-        return func(self, *args, **kwargs)
+        data = cache.get(key)
+        if is_future(data):
+            return resolve(cache, key, data, args, kwargs)
+        if data is None:
+            return compute(cache, key, args, kwargs)
+        result = cache.serializer.loads(data)[0]
+        if local:
+            memo.set(key, [result], timeout)
+        return coroutine and gen.maybe_future(result) or result
     return wrapper
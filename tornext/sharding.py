@@ -21,57 +21,422 @@
  and see this article http://amix.dk/blog/viewEntry/19367
 
 ref: https://github.com/Doist/hash_ring
+
+Strategies, all behind the same `get_node()` API:
+    Sharding            CRC32 ring with `replicas` virtual points per node.
+    KetamaSharding      ring with MD5-based points (libmemcached ketama compatible).
+    JumpSharding        Jump Consistent Hash for numbered shards, O(1) memory.
+    RendezvousSharding  highest random weight (HRW) hashing for small clusters.
+
+Run `tornext benchmark` to compare their distribution & throughput.
+
+Rings can be saved into a binary snapshot (`Sharding.save`) and loaded via mmap
+(`Sharding.load`), so pre-forked workers share one ring instead of rebuilding it.
 """
 from __future__ import absolute_import
 
+import os
+import json
+import math
+import mmap
 import zlib
+import array
 import bisect
+import struct
+import hashlib
+import operator
+import collections
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from tornext import compat
 
 
-class Sharding(object):
+# immutable view of the ring used by lookups: sorted points, the index (into
+# `nodes`) of the node owning every point, and the nodes by index.
+Ring = collections.namedtuple('Ring', ('points', 'owners', 'nodes'))
+
+# snapshot header: magic, version, number of points, size of the (padded) metadata.
+SNAPSHOT = struct.Struct('=4sIII')
+
+# hashes in [start, stop) moving from node `source` to node `target`.
+Move = collections.namedtuple('Move', ('start', 'stop', 'source', 'target'))
+
+
+MASK64 = 0xffffffffffffffff
+
+
+def hash_tag(key):
+    """Part of `key` being hashed: the content of the first non-empty `{...}`
+    (Redis Cluster hash tags), or the whole key.
+
+    Keys sharing a tag, e.g. '{user:42}profile' & '{user:42}cart', land on the same node.
+    """
+    left, right = isinstance(key, bytes) and (b'{', b'}') or (u'{', u'}')
+    start = key.find(left)
+    if start < 0:
+        return key
+    stop = key.find(right, start + 1)
+    if stop <= start + 1:
+        return key
+    return key[start + 1:stop]
+
+
+def frombytes(data):
+    """Returns: `array('I')` holding the native unsigned integers of `data`."""
+    points = array.array('I')
+    if compat.IsPy3:
+        points.frombytes(data)
+    else:
+        points.fromstring(data)
+    return points
+
+
+def tobytes(points):
+    if isinstance(points, array.array) and not compat.IsPy3:
+        return points.tostring()
+    return points.tobytes()
+
+
+def crc32(key):
+    """Unsigned CRC32 of `key`, identical on Python 2 & 3."""
+    return zlib.crc32(compat.Byte(key)) & 0xffffffff
+
+
+def md5_32(key):
+    """First (little-endian) 32 bits of the MD5 digest of `key`."""
+    return struct.unpack_from('<I', hashlib.md5(compat.Byte(key)).digest())[0]
+
+
+def md5_64(key):
+    """First (little-endian) 64 bits of the MD5 digest of `key`."""
+    return struct.unpack_from('<Q', hashlib.md5(compat.Byte(key)).digest())[0]
+
+
+def fmix64(value):
+    """MurmurHash3 64-bit finalizer, scrambles every bit of `value`."""
+    value ^= value >> 33
+    value  = (value * 0xff51afd7ed558ccd) & MASK64
+    value ^= value >> 33
+    value  = (value * 0xc4ceb9fe1a85ec53) & MASK64
+    value ^= value >> 33
+    return value
+
+
+def jump_hash(key, buckets):
+    """Jump Consistent Hash (Lamping & Veach), maps 64-bit `key` into [0, buckets)."""
+    b, j = -1, 0
+    while j < buckets:
+        b   = j
+        key = (key * 2862933555777941757 + 1) & MASK64
+        j   = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+class BaseSharding(object):
+    """Common API of the sharding strategies.
+
+    Resolved nodes of up to `memo_size` keys are memoized in a plain dict that
+    is cleared once full (keeps misses as cheap as a lookup), the memo is also
+    cleared whenever the nodes change.
+    """
+
+    # only hash the `{...}` part of keys (see `hash_tag`), set before the first lookup.
+    hash_tags = True
+
+    memo_size = 4096
+
+    def __init__(self):
+        self.memo = {}
+
+    def shard_key(self, key):
+        return self.hash_tags and hash_tag(key) or key
+
+    def get_node(self, key):
+        """Given a string key a corresponding node is returned.
+
+        If there are no nodes, `None` is returned.
+        """
+        memo = self.memo
+        node = memo.get(key, memo)
+        if node is memo:
+            node = self.lookup(key)
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            memo[key] = node
+        return node
+
+    def lookup(self, key):
+        """Resolve the node of `key` without the memo."""
+        raise NotImplementedError
+
+    @staticmethod
+    def weighted(nodes):
+        """Returns: list of (node, weight) tuples from a list of nodes or a `{node: weight}` dict."""
+        if isinstance(nodes, dict):
+            return list(compat.iteritems(nodes))
+        return [(node, 1) for node in nodes]
+
+    @staticmethod
+    def check_weight(weight):
+        if not weight > 0:
+            raise ValueError('Node weight must be positive: %r' % weight)
+
+    def get_nodes(self, keys):
+        """Resolve the nodes of a batch of keys.
+
+        Returns: (nodes, groups), where nodes is the node per key (in the order
+                 of `keys`) and groups the `{node: [indexes]}` mapping.
+        """
+        nodes = [self.get_node(key) for key in keys]
+        return nodes, self.group(nodes)
+
+    @staticmethod
+    def group(nodes):
+        """Returns: `{node: [indexes]}` mapping of `nodes`."""
+        groups = collections.defaultdict(list)
+        for index, node in enumerate(nodes):
+            if node is not None:
+                groups[node].append(index)
+        return dict(groups)
+
+    def __call__(self, key):
+        return self.get_node(key)
+
+
+
+class Sharding(BaseSharding):
     """Consistent hash for nosql API"""
+
+    # hash of keys & virtual points, must return unsigned 32-bit integers.
+    hash = staticmethod(crc32)
+
     def __init__(self, nodes=[], replicas=128):
         """Manages a hash ring.
 
-        `nodes` is a list of objects that have a proper __str__ representation.
-        `replicas` indicates how many virtual points should be used pr. node,
-        replicas are required to improve the distribution.
+        `nodes` is a list of objects that have a proper __str__ representation,
+        or a `{node: weight}` dict for heterogeneous nodes.
+        `replicas` indicates how many virtual points should be used pr. node
+        (of weight 1), replicas are required to improve the distribution.
+
+        The ring is kept in two parallel typed arrays: the sorted points and
+        the index of the node owning each point.
         """
+        super(Sharding, self).__init__()
         self.nodes = set()
+        self.weights  = {}
         self.replicas = replicas
-        self.ring = {}
-        self.sorted_keys = []
+        self.points = array.array('I')
+        self.owners = array.array('I')
+        self.slots  = []
+        self._ring  = None
 
-        for n in nodes:
-            self.add_node(n)
+        # build the ring in bulk, sorting every point once.
+        pairs = []
+        for n, weight in self.weighted(nodes):
+            if n not in self.nodes:
+                pairs.extend(self._add(n, weight))
+        self._insert(pairs)
 
-    def add_node(self, node):
-        """Adds a `node` to the hash ring (including a number of replicas).
+    def _count(self, weight):
+        return max(int(round(self.replicas * weight)), 1)
+
+    def _points(self, node, start, stop):
+        return [self.hash("%s:%d" % (node, x)) for x in compat.xrange(start, stop)]
+
+    def _writable(self):
+        # a loaded ring is backed by the (read-only) snapshot.
+        if not isinstance(self.points, array.array):
+            self.points = frombytes(tobytes(self.points))
+            self.owners = frombytes(tobytes(self.owners))
+
+    def _rebuild(self, points, owners):
+        self.points = points
+        self.owners = owners
+        self._ring = None
+        self.memo.clear()
+
+    def _insert(self, pairs):
+        """Merge (point, slot) `pairs` into the ring in a single pass,
+        new points go after the existing points of the same value.
         """
+        self._writable()
+        pairs = sorted(pairs, key=operator.itemgetter(0))
+        if not self.points:
+            self._rebuild(array.array('I', [point for point, _ in pairs]),
+                          array.array('I', [slot for _, slot in pairs]))
+            return
+        points, owners = array.array('I'), array.array('I')
+        start = 0
+        for point, slot in pairs:
+            stop = bisect.bisect_right(self.points, point, start)
+            points.extend(self.points[start:stop])
+            owners.extend(self.owners[start:stop])
+            points.append(point)
+            owners.append(slot)
+            start = stop
+        points.extend(self.points[start:])
+        owners.extend(self.owners[start:])
+        self._rebuild(points, owners)
+
+    def _delete(self, slot, points):
+        """Remove `points` of `slot` from the ring in a single pass."""
+        self._writable()
+        removed = set()
+        for point in points:
+            idx = bisect.bisect_left(self.points, point)
+            while self.owners[idx] != slot or idx in removed:
+                idx += 1
+            removed.add(idx)
+        kept_points, kept_owners = array.array('I'), array.array('I')
+        start = 0
+        for idx in sorted(removed):
+            kept_points.extend(self.points[start:idx])
+            kept_owners.extend(self.owners[start:idx])
+            start = idx + 1
+        kept_points.extend(self.points[start:])
+        kept_owners.extend(self.owners[start:])
+        self._rebuild(kept_points, kept_owners)
+
+    def _add(self, node, weight):
+        """Register `node`, returns: (point, slot) pairs of its replicas."""
+        self.check_weight(weight)
         self.nodes.add(node)
-        for x in compat.xrange(self.replicas):
-            crckey = zlib.crc32(compat.Byte("%s:%d" % (node, x)))
-            self.ring[crckey] = node
-            self.sorted_keys.append(crckey)
+        self.weights[node] = weight
+        if None in self.slots:
+            slot = self.slots.index(None)
+            self.slots[slot] = node
+        else:
+            slot = len(self.slots)
+            self.slots.append(node)
+        return [(point, slot) for point in self._points(node, 0, self._count(weight))]
 
-        self.sorted_keys.sort()
+    def add_node(self, node, weight=1):
+        """Adds a `node` to the hash ring (including a number of replicas).
+        """
+        if node in self.nodes:
+            return
+        self._insert(self._add(node, weight))
 
     def remove_node(self, node):
         """Removes `node` from the hash ring and its replicas.
         """
         self.nodes.remove(node)
-        for x in compat.xrange(self.replicas):
-            crckey = zlib.crc32(compat.Byte("%s:%d" % (node, x)))
-            self.ring.remove(crckey)
-            self.sorted_keys.remove(crckey)
+        slot = self.slots.index(node)
+        self._delete(slot, self._points(node, 0, self._count(self.weights.pop(node))))
+        self.slots[slot] = None
 
-    def get_node(self, key):
-        """Given a string key a corresponding node in the hash ring is returned.
+    def set_weight(self, node, weight):
+        """Change the weight of `node` at runtime.
+
+        Only the virtual points beyond the smaller of the old & new counts are
+        added/removed, so only keys moving to/from `node` change their owner.
+        """
+        self.check_weight(weight)
+        slot = self.slots.index(node)
+        old, new = self._count(self.weights[node]), self._count(weight)
+        self.weights[node] = weight
+        if new > old:
+            self._insert([(point, slot) for point in self._points(node, old, new)])
+        elif new < old:
+            self._delete(slot, self._points(node, new, old))
+
+    @property
+    def ring(self):
+        """Immutable snapshot of the ring, rebuilt after membership changes."""
+        ring = self._ring
+        if ring is None:
+            ring = self._ring = Ring(array.array('I', self.points),
+                                     array.array('I', self.owners), tuple(self.slots))
+        return ring
+
+    def save(self, path):
+        """Write the ring into a binary snapshot at `path` (atomically replaced).
+
+        The points & owners are stored in native byte order, snapshots are
+        meant to be shared by the processes on one host, see `load()`.
+        """
+        ring = self.ring
+        meta = json.dumps({
+            'strategy': type(self).__name__,
+            'replicas': self.replicas,
+            'nodes': [node is not None and [node, self.weights[node]] or None for node in ring.nodes],
+        }).encode('utf-8')
+        meta += b' ' * (-len(meta) % 4)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT.pack(b'TNXR', 1, len(ring.points), len(meta)))
+            f.write(meta)
+            f.write(tobytes(ring.points))
+            f.write(tobytes(ring.owners))
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a ring written by `save()` without rebuilding it.
+
+        The snapshot is memory-mapped, with NumPy the ring is used in place
+        so every process on the host shares the same pages.
+        """
+        with open(path, 'rb') as f:
+            memory = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, size = SNAPSHOT.unpack_from(memory, 0)
+        if magic != b'TNXR' or version != 1:
+            raise ValueError('Not a ring snapshot: %s' % path)
+        meta = json.loads(memory[SNAPSHOT.size:SNAPSHOT.size + size].decode('utf-8'))
+        if meta['strategy'] != cls.__name__:
+            raise ValueError('Cannot load %s snapshot as %s' % (meta['strategy'], cls.__name__))
+
+        sharding = cls(replicas=meta['replicas'])
+        for slot, item in enumerate(meta['nodes']):
+            sharding.slots.append(item and item[0])
+            if item:
+                sharding.nodes.add(item[0])
+                sharding.weights[item[0]] = item[1]
+        offset = SNAPSHOT.size + size
+        if numpy is not None:
+            sharding.points = numpy.frombuffer(memory, numpy.uint32, count, offset)
+            sharding.owners = numpy.frombuffer(memory, numpy.uint32, count, offset + 4 * count)
+        else:
+            sharding.points = frombytes(memory[offset:offset + 4 * count])
+            sharding.owners = frombytes(memory[offset + 4 * count:offset + 8 * count])
+        sharding._ring = Ring(sharding.points, sharding.owners, tuple(sharding.slots))
+        return sharding
 
-        If the hash ring is empty, `None` is returned.
+    def owner(self, value):
+        """Returns: node owning hash `value`, None if the ring is empty."""
+        ring = self.ring
+        if len(ring.points) == 0:
+            return None
+        idx = bisect.bisect(ring.points, value)
+        return ring.nodes[ring.owners[idx if idx < len(ring.points) else 0]]
+
+    def diff(self, other):
+        """Compute the hash ranges changing their owner from this ring to `other`.
+
+        Ownership only changes at the points of either ring, so the owners
+        are compared once per segment between consecutive points.
+
+        Returns: list of `Move(start, stop, source, target)` tuples, adjacent
+                 ranges with the same source & target are merged.
         """
+        if type(other) is not type(self):
+            raise ValueError('Cannot diff %s against %s' % (type(self).__name__, type(other).__name__))
+        bounds = sorted(set(self.ring.points) | set(other.ring.points) | set([0]))
+        bounds.append(1 << 32)
+        moves  = []
+        for start, stop in zip(bounds, bounds[1:]):
+            source, target = self.owner(start), other.owner(start)
+            if source == target:
+                continue
+            if moves and moves[-1].stop == start and moves[-1][2:] == (source, target):
+                moves[-1] = moves[-1]._replace(stop=stop)
+            else:
+                moves.append(Move(start, stop, source, target))
+        return moves
+
+    def lookup(self, key):
         n, i = self.get_node_pos(key)
         return n
 
@@ -81,22 +446,173 @@ class Sharding(object):
 
         If the hash ring is empty, (`None`, `None`) is returned.
         """
-        if len(self.ring) == 0:
+        ring = self.ring
+        if len(ring.points) == 0:
             return [None, None]
-        crc = zlib.crc32(compat.Byte(key))
-        idx = bisect.bisect(self.sorted_keys, crc)
-        idx = min(idx, (self.replicas * len(self.nodes)) - 1)
-        # prevents out of range index
-        return [self.ring[self.sorted_keys[idx]], idx]
+        idx = self._locate(ring, key)
+        return [ring.nodes[ring.owners[idx]], idx]
+
+    def _locate(self, ring, key):
+        idx = bisect.bisect(ring.points, self.hash(self.shard_key(key)))
+        # wraps around past the last point.
+        return idx if idx < len(ring.points) else 0
+
+    def get_nodes(self, keys):
+        """Resolve the nodes of a batch of keys at once, the ring is searched
+        with `numpy.searchsorted` when NumPy is available.
+        """
+        ring = self.ring
+        if len(ring.points) == 0:
+            return [None] * len(keys), {}
+        hashes = [self.hash(self.shard_key(key)) for key in keys]
+        if numpy is not None:
+            points = numpy.frombuffer(ring.points, dtype=numpy.uint32)
+            found  = numpy.searchsorted(points, numpy.array(hashes, dtype=numpy.uint32), side='right')
+            found[found == len(points)] = 0
+            slots  = numpy.frombuffer(ring.owners, dtype=numpy.uint32)[found].tolist()
+        else:
+            search, points, owners, size = bisect.bisect, ring.points, ring.owners, len(ring.points)
+            slots = [owners[idx if idx < size else 0]
+                     for idx in (search(points, value) for value in hashes)]
+        nodes = [ring.nodes[slot] for slot in slots]
+        return nodes, self.group(nodes)
 
     def iter_nodes(self, key):
         """Given a string key it returns the nodes as a generator that can hold the key.
+
+        The owner of `key` comes first, followed by the other distinct nodes
+        in ring order (wrapping around), e.g. as failover or replica targets.
         """
-        if len(self.ring) == 0:
-            yield None, None
-        node, pos = self.get_node_pos(key)
-        for k in self.sorted_keys[pos:]:
-            yield k, self.ring[k]
+        ring = self.ring
+        if len(ring.points) == 0:
+            return
+        pos   = self._locate(ring, key)
+        total = len(ring.nodes) - ring.nodes.count(None)
+        seen  = set()
+        for idx in compat.xrange(pos, pos + len(ring.points)):
+            slot = ring.owners[idx % len(ring.points)]
+            if slot not in seen:
+                seen.add(slot)
+                yield ring.nodes[slot]
+                if len(seen) == total:
+                    return
 
-    def __call__(self, key):
-        return self.get_node(key)
+
+
+class KetamaSharding(Sharding):
+    """Ketama ring: every MD5 digest of "<node>-<n>" yields 4 virtual points,
+    keys are placed by the first 32 bits of their MD5 digest.
+
+    MD5 spreads points far more evenly than CRC32 over short, similar strings,
+    which matters most for small node counts.
+    """
+    hash = staticmethod(md5_32)
+
+    def __init__(self, nodes=[], replicas=160):
+        super(KetamaSharding, self).__init__(nodes, replicas)
+
+    def _points(self, node, start, stop):
+        points = []
+        for x in compat.xrange(start // 4, (stop + 3) // 4):
+            points.extend(struct.unpack('<4I', hashlib.md5(compat.Byte("%s-%d" % (node, x))).digest()))
+        return points[start % 4:start % 4 + stop - start]
+
+
+
+class JumpSharding(BaseSharding):
+    """Jump Consistent Hash for numbered shards.
+
+    No ring is kept at all (O(1) memory), nodes are numbered by insertion order
+    and only the last node can be removed, which suits fixed shard lists.
+    Weights are not supported, all shards receive the same share of keys.
+    """
+    def __init__(self, nodes=[]):
+        super(JumpSharding, self).__init__()
+        self.slots = []
+        self.nodes = set()
+        for n, weight in self.weighted(nodes):
+            self.add_node(n, weight)
+
+    def add_node(self, node, weight=1):
+        if weight != 1:
+            raise ValueError('JumpSharding does not support node weights: %r' % node)
+        if node not in self.nodes:
+            self.nodes.add(node)
+            self.slots.append(node)
+            self.memo.clear()
+
+    def remove_node(self, node):
+        if not self.slots or self.slots[-1] != node:
+            raise ValueError('Only the last node can be removed from JumpSharding: %r' % node)
+        self.nodes.remove(node)
+        self.slots.pop()
+        self.memo.clear()
+
+    def lookup(self, key):
+        if not self.slots:
+            return None
+        return self.slots[jump_hash(md5_64(self.shard_key(key)), len(self.slots))]
+
+    def iter_nodes(self, key):
+        """The owner of `key`, followed by the other nodes by number (wrapping around)."""
+        if not self.slots:
+            return
+        pos = jump_hash(md5_64(self.shard_key(key)), len(self.slots))
+        for idx in compat.xrange(pos, pos + len(self.slots)):
+            yield self.slots[idx % len(self.slots)]
+
+
+
+class RendezvousSharding(BaseSharding):
+    """Highest random weight (HRW) hashing: every node scores every key,
+    the highest score wins. Lookups are O(nodes), so keep it to small clusters;
+    in exchange the distribution is ideal and no ring is needed.
+
+    Weighted nodes use the logarithmic method, `-weight / ln(hash)`, changing
+    the weight of a node only moves keys to/from that node.
+    """
+    def __init__(self, nodes=[]):
+        super(RendezvousSharding, self).__init__()
+        self.seeds = {}
+        self.nodes = set()
+        self.weights = {}
+        for n, weight in self.weighted(nodes):
+            self.add_node(n, weight)
+
+    def add_node(self, node, weight=1):
+        self.check_weight(weight)
+        self.nodes.add(node)
+        self.seeds[node] = md5_64("%s" % node)
+        self.weights[node] = weight
+        self.memo.clear()
+
+    def remove_node(self, node):
+        self.nodes.remove(node)
+        del self.seeds[node]
+        del self.weights[node]
+        self.memo.clear()
+
+    def set_weight(self, node, weight):
+        self.check_weight(weight)
+        self.weights[node] = weight
+        self.memo.clear()
+
+    def scores(self, key):
+        """Returns: list of (score, node) tuples for `key`."""
+        value = md5_64(self.shard_key(key))
+        scores = []
+        for node, seed in compat.iteritems(self.seeds):
+            # uniform in (0, 1), the log turns it into an exponential variate.
+            score = ((fmix64(seed ^ value) >> 11) + 0.5) / 9007199254740992.0
+            scores.append((-self.weights[node] / math.log(score), node))
+        return scores
+
+    def lookup(self, key):
+        if not self.seeds:
+            return None
+        return max(self.scores(key))[1]
+
+    def iter_nodes(self, key):
+        """All nodes by descending score, the owner of `key` first."""
+        for _, node in sorted(self.scores(key), reverse=True):
+            yield node
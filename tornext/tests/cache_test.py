@@ -0,0 +1,778 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import pickle
+
+from concurrent.futures import ThreadPoolExecutor
+from redis.client import Redis
+from tornado import gen
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+from tornado.web import Application, RequestHandler
+from tornado.tcpserver import TCPServer
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, bind_unused_port, gen_test
+
+from tornext.cache import protocol, cache, expand_tags, invalidate_tags, AbstractCache, CacheMixin
+from tornext.cache.local import LocalCache, TieredCache
+from tornext.cache.serializers import Serializer
+from tornext.cache.redis import AsyncRedisCache, HotKeys
+from tornext.commands import rebalance
+
+
+
+class RedisServer(TCPServer):
+    """In-memory server speaking just enough RESP for the tests."""
+
+    def __init__(self, *args, **kwargs):
+        super(RedisServer, self).__init__(*args, **kwargs)
+        self.data = {}
+        # key -> expiry timestamp (milliseconds).
+        self.expires  = {}
+        self.commands = []
+
+
+    @gen.coroutine
+    def read_command(self, stream):
+        line = yield stream.read_until(b'\r\n')
+        args = []
+        for _ in range(int(line[1:-2])):
+            line = yield stream.read_until(b'\r\n')
+            data = yield stream.read_bytes(int(line[1:-2]) + 2)
+            args.append(data[:-2])
+        raise gen.Return(args)
+
+
+    def reply(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, int):
+            return (':%d\r\n' % value).encode()
+        if isinstance(value, protocol.ReplyError):
+            return ('-%s\r\n' % value).encode()
+        if isinstance(value, list):
+            return ('*%d\r\n' % len(value)).encode() + b''.join(map(self.reply, value))
+        return ('$%d\r\n' % len(value)).encode() + value + b'\r\n'
+
+
+    def execute(self, name, *args):
+        name = name.upper()
+        now  = int(time.time() * 1000)
+        for key in [key for key, expires in self.expires.items() if expires <= now]:
+            self.data.pop(key, None)
+            del self.expires[key]
+        if name == b'PING':
+            return b'PONG'
+        if name == b'GET':
+            return self.data.get(args[0])
+        if name == b'SET':
+            if b'NX' in args[2:] and args[0] in self.data:
+                return None
+            self.data[args[0]] = args[1]
+            self.expires.pop(args[0], None)
+            if b'EX' in args[2:]:
+                self.expires[args[0]] = now + 1000 * int(args[args.index(b'EX') + 1])
+            return b'OK'
+        if name == b'INCRBY':
+            self.data[args[0]] = str(int(self.data.get(args[0], 0)) + int(args[1])).encode()
+            return int(self.data[args[0]])
+        if name == b'MGET':
+            return [self.data.get(key) for key in args]
+        if name == b'MSET':
+            self.data.update(zip(args[::2], args[1::2]))
+            return b'OK'
+        if name == b'EXISTS':
+            return int(args[0] in self.data)
+        if name == b'DEL':
+            for key in args:
+                self.expires.pop(key, None)
+            return sum(self.data.pop(key, None) is not None for key in args)
+        if name == b'SCAN':
+            return [b'0', sorted(self.data)]
+        if name == b'PTTL':
+            if args[0] not in self.data:
+                return -2
+            return args[0] in self.expires and self.expires[args[0]] - now or -1
+        if name == b'DUMP':
+            return args[0] in self.data and b'dump:' + self.data[args[0]] or None
+        if name == b'RESTORE':
+            if args[0] in self.data and b'REPLACE' not in args[3:]:
+                return protocol.ReplyError('BUSYKEY Target key name already exists.')
+            self.data[args[0]] = args[2][len(b'dump:'):]
+            self.expires.pop(args[0], None)
+            if int(args[1]):
+                self.expires[args[0]] = now + int(args[1])
+            return b'OK'
+        return protocol.ReplyError('ERR unknown command')
+
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        while not stream.closed():
+            try:
+                args = yield self.read_command(stream)
+            except Exception:
+                break
+            self.commands.append(args)
+            yield stream.write(self.reply(self.execute(*args)))
+
+
+
+class AsyncRedisTest(AsyncTestCase):
+
+    def setUp(self):
+        super(AsyncRedisTest, self).setUp()
+        sock, port = bind_unused_port()
+        self.server = RedisServer()
+        self.server.add_socket(sock)
+        self.url = 'redis://127.0.0.1:%d/0' % port
+
+
+    def tearDown(self):
+        self.server.stop()
+        super(AsyncRedisTest, self).tearDown()
+
+
+    def test_parse_url(self):
+        settings = protocol.parse_url('redis://:secret@example.com:6380/2', socket_timeout=1)
+        self.assertEqual(settings['host'], 'example.com')
+        self.assertEqual(settings['port'], 6380)
+        self.assertEqual(settings['db'], 2)
+        self.assertEqual(settings['password'], 'secret')
+        self.assertEqual(settings['socket_timeout'], 1)
+
+
+    @gen_test
+    def test_commands(self):
+        client = protocol.AsyncRedis.from_url(self.url)
+        self.assertEqual((yield client.ping()), b'PONG')
+        yield client.set('key', 'value')
+        self.assertEqual((yield client.get('key')), b'value')
+        self.assertTrue((yield client.exists('key')))
+        self.assertEqual((yield client.delete('key')), 1)
+        self.assertIsNone((yield client.get('key')))
+        with self.assertRaises(protocol.ReplyError):
+            yield client.execute_command('UNKNOWN')
+
+
+    @gen_test
+    def test_select_failure(self):
+        client = protocol.AsyncRedis.from_url(self.url[:-1] + '2')
+        for _ in range(2):
+            with self.assertRaises(protocol.ConnectionError):
+                yield client.set('key', 'value')
+        # nothing written to db 0 by the retry.
+        self.assertEqual(self.server.data, {})
+
+
+    @gen_test
+    def test_pipeline(self):
+        client  = protocol.AsyncRedis.from_url(self.url)
+        replies = yield client.pipeline([('SET', 'a', 1), ('GET', 'a'), ('UNKNOWN',)])
+        self.assertEqual(replies[:2], [b'OK', b'1'])
+        self.assertIsInstance(replies[2], protocol.ReplyError)
+
+
+    @gen_test
+    def test_bounded_pool(self):
+        client = protocol.AsyncRedis.from_url(self.url, max_connections=2)
+        yield [client.set('key:%d' % x, x) for x in range(10)]
+        self.assertEqual(client.connection_pool.created, 2)
+        self.assertEqual(len(self.server.data), 10)
+
+
+    @gen_test
+    def test_async_cache(self):
+        cache = AsyncRedisCache([self.url])
+        self.assertFalse((yield cache.exists('key')))
+        yield cache.set('key', b'value', 60)
+        self.assertTrue((yield cache.exists('key')))
+        self.assertEqual((yield cache.get('key')), b'value')
+        yield cache.delete('key')
+        self.assertIsNone((yield cache.get('key')))
+        self.assertTrue((yield cache.add('key', b'1', 10)))
+        self.assertFalse((yield cache.add('key', b'2', 10)))
+        self.assertEqual((yield cache.get('key')), b'1')
+        self.assertEqual((yield cache.incr('counter')), 1)
+        self.assertEqual((yield cache.incr('counter', 2)), 3)
+
+
+    @gen_test
+    def test_async_cache_bulk(self):
+        servers = [self.server]
+        urls    = [self.url]
+        for _ in range(2):
+            sock, port = bind_unused_port()
+            servers.append(RedisServer())
+            servers[-1].add_socket(sock)
+            urls.append('redis://127.0.0.1:%d' % port)
+        cache = AsyncRedisCache(urls)
+        keys  = ['key:%d' % x for x in range(50)]
+        yield cache.set_many(dict((key, key.upper()) for key in keys))
+        yield cache.set_many({'ttl': b'1'}, 60)
+        # one batch per node owning any of the keys (+1 for 'ttl').
+        owners = [server for server in servers if set(server.data) - set([b'ttl'])]
+        self.assertEqual(sum(len(server.commands) for server in servers), len(owners) + 1)
+        self.assertEqual(sum(len(server.data) for server in servers), 51)
+
+        values = yield cache.get_many(keys + ['missing'])
+        self.assertEqual(values, [key.upper().encode() for key in keys] + [None])
+        yield cache.delete_many(keys[:25])
+        values = yield cache.get_many(keys)
+        self.assertEqual(values.count(None), 25)
+        for server in servers[1:]:
+            server.stop()
+
+
+    @gen_test
+    def test_async_cache_bulk_error(self):
+        execute = self.server.execute
+        self.server.execute = lambda name, *args: (
+            protocol.ReplyError('OOM command not allowed') if args[:1] == (b'bad',)
+            else execute(name, *args))
+        cache = AsyncRedisCache([self.url])
+        with self.assertRaises(protocol.ReplyError):
+            yield cache.set_many({'good': b'1', 'bad': b'2'}, 60)
+        self.assertEqual(self.server.data, {b'good': b'1'})
+        # the node is still healthy, error replies are not connection failures.
+        self.assertTrue(cache.health[self.url].healthy)
+
+
+    @gen_test
+    def test_failover(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        dead  = 'redis://127.0.0.1:%d' % port
+        cache = AsyncRedisCache([self.url, dead], failure_threshold=1)
+        keys  = [key for key in ('key:%d' % x for x in range(50))
+                 if cache.sharding.get_node(key) == dead]
+        # the first request to the dead node degrades to a miss and opens its breaker.
+        self.assertIsNone((yield cache.get(keys[0])))
+        self.assertFalse(cache.health[dead].healthy)
+        self.assertIsNotNone(cache.prober)
+        # its keys fall over to the next live node.
+        yield cache.set_many(dict((key, b'value') for key in keys))
+        self.assertEqual((yield cache.get_many(keys)), [b'value'] * len(keys))
+        self.assertEqual(cache.route(keys[0]), self.url)
+
+        server = RedisServer()
+        server.listen(port, '127.0.0.1')
+        yield cache.probe()
+        self.assertTrue(cache.health[dead].healthy)
+        self.assertIsNone(cache.prober)
+        self.assertEqual(cache.route(keys[0]), dead)
+        server.stop()
+
+
+    @gen_test
+    def test_hot_keys(self):
+        servers = [self.server]
+        urls    = [self.url]
+        for _ in range(2):
+            sock, port = bind_unused_port()
+            servers.append(RedisServer())
+            servers[-1].add_socket(sock)
+            urls.append('redis://127.0.0.1:%d' % port)
+        cache = AsyncRedisCache(urls, hot_keys=HotKeys(threshold=3, sample_rate=1))
+        yield cache.set('home', b'page')
+        for _ in range(3):
+            self.assertEqual((yield cache.get('home')), b'page')
+        self.assertIn('home', cache.hot)
+        self.assertEqual(len(cache.owners('home')), 3)
+        # reads are spread across the replicas, which are refilled from the owner.
+        for _ in range(30):
+            self.assertEqual((yield cache.get('home')), b'page')
+        self.assertTrue(all(server.data.get(b'home') == b'page' for server in servers))
+        reads = [sum(command[0] == b'GET' for command in server.commands) for server in servers]
+        self.assertTrue(all(reads))
+        # writes & deletes reach every replica.
+        yield cache.set('home', b'new', 60)
+        self.assertTrue(all(server.data.get(b'home') == b'new' for server in servers))
+        yield cache.delete('home')
+        self.assertFalse(any(b'home' in server.data for server in servers))
+        for server in servers[1:]:
+            server.stop()
+
+
+
+class RebalanceTest(AsyncTestCase):
+
+    def setUp(self):
+        super(RebalanceTest, self).setUp()
+        self.servers, self.urls = [], []
+        for _ in range(2):
+            sock, port = bind_unused_port()
+            self.servers.append(RedisServer())
+            self.servers[-1].add_socket(sock)
+            self.urls.append('redis://127.0.0.1:%d' % port)
+        self.executor = ThreadPoolExecutor(1)
+
+
+    def tearDown(self):
+        self.executor.shutdown()
+        for server in self.servers:
+            server.stop()
+        super(RebalanceTest, self).tearDown()
+
+
+    def test_parse_nodes(self):
+        self.assertEqual(rebalance.parse_nodes('redis://a:6379,,redis://b:6379'),
+                         ['redis://a:6379', 'redis://b:6379'])
+        self.assertEqual(rebalance.parse_nodes('redis://a:6379=2,unix:///tmp/redis.sock?db=1'),
+                         {'redis://a:6379': 2, 'unix:///tmp/redis.sock?db=1': 1})
+        self.assertEqual(rebalance.parse_nodes('unix:///tmp/redis.sock?db=1=0.5'),
+                         {'unix:///tmp/redis.sock?db=1': 0.5})
+        args = {'--strategy': 'rendezvous', '--replicas': '64'}
+        self.assertRaises(SystemExit, rebalance.create_sharding, args, 'redis://a:6379')
+
+
+    @gen_test
+    def test_migrate(self):
+        args = {'--strategy': 'ketama', '--replicas': '40', '--batch': '20', '--delete': True}
+        old  = rebalance.create_sharding(args, self.urls[0])
+        new  = rebalance.create_sharding(args, '%s=1,%s=3' % tuple(self.urls))
+        self.assertEqual(new.weights, {self.urls[0]: 1, self.urls[1]: 3})
+        source, target = self.servers
+        expires = int(time.time() * 1000) + 60000
+        for x in range(100):
+            key = ('key:%d' % x).encode()
+            source.data[key] = b'value'
+            if x % 2:
+                source.expires[key] = expires
+        moving = sorted(key for key in source.data if new.get_node(key) == self.urls[1])
+        clients = dict((url, Redis.from_url(url)) for url in self.urls)
+        copied = yield self.executor.submit(rebalance.migrate, self.urls[0], old, new, clients,
+                                            args, rebalance.Throttle(0))
+        self.assertEqual(copied, len(moving))
+        self.assertEqual(sorted(target.data), moving)
+        self.assertEqual(len(source.data), 100 - len(moving))
+        # TTLs are preserved, keys without one stay persistent.
+        for key in moving:
+            if int(key[4:]) % 2:
+                self.assertLess(abs(target.expires[key] - expires), 1000)
+            else:
+                self.assertNotIn(key, target.expires)
+
+
+    def test_throttle(self):
+        started  = time.time()
+        throttle = rebalance.Throttle(200)
+        throttle(10)
+        throttle(10)
+        self.assertGreaterEqual(time.time() - started, 0.09)
+        started = time.time()
+        rebalance.Throttle(0)(1000)
+        self.assertLess(time.time() - started, 0.05)
+
+
+
+class Connection(object):
+
+    def set_close_callback(self, callback):
+        pass
+
+
+
+class DictCache(AbstractCache):
+    """Blocking in-memory cache recording every call."""
+
+    def __init__(self):
+        self.data  = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append('get')
+        return self.data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.calls.append('set')
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def exists(self, key):
+        self.calls.append('exists')
+        return key in self.data
+
+    def incr(self, key, delta=1):
+        self.data[key] = int(self.data.get(key, 0)) + delta
+        return self.data[key]
+
+    def add(self, key, value, timeout=None):
+        self.calls.append('add')
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+
+
+class LocalCacheTest(AsyncTestCase):
+
+    def test_lru_eviction(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        cache.get('a')
+        cache.set('c', b'3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('c'), b'3')
+
+
+    def test_bytes_bound(self):
+        cache = LocalCache(max_bytes=10)
+        cache.set('a', b'x' * 6)
+        cache.set('b', b'x' * 6)
+        self.assertFalse(cache.exists('a'))
+        self.assertEqual(cache.size, 6)
+        cache.set('c', b'x' * 11)
+        self.assertFalse(cache.exists('c'))
+
+
+    def test_ttl(self):
+        cache = LocalCache()
+        cache.timer = lambda: 100
+        cache.set('a', b'1', 10)
+        self.assertEqual(cache.get('a'), b'1')
+        cache.timer = lambda: 110
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+    def test_tiered(self):
+        backend = DictCache()
+        cache = TieredCache(backend, max_staleness=1)
+        backend.set('a', b'1')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(backend.calls.count('get'), 2)
+        self.assertEqual(cache.stats.l1, {'hits': 1, 'misses': 2})
+        self.assertEqual(cache.stats.l2, {'hits': 1, 'misses': 1})
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+        cache.set_many({'a': b'1', 'b': b'2'})
+        cache.local.delete('b')
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), [b'1', b'2', None])
+
+
+    def test_tiered_staleness(self):
+        cache = TieredCache(DictCache(), max_staleness=5)
+        cache.local.timer = lambda: 100
+        cache.set('a', b'1', 3600)
+        cache.backend.data['a'] = b'2'
+        self.assertEqual(cache.get('a'), b'1')
+        cache.local.timer = lambda: 105
+        self.assertEqual(cache.get('a'), b'2')
+
+
+    @gen_test
+    def test_tiered_async(self):
+        sock, port = bind_unused_port()
+        server = RedisServer()
+        server.add_socket(sock)
+        cache = TieredCache(AsyncRedisCache(['redis://127.0.0.1:%d' % port]))
+        yield cache.set('a', b'1')
+        cache.local.clear()
+        self.assertEqual((yield cache.get('a')), b'1')
+        self.assertEqual(cache.get('a'), b'1')
+        server.stop()
+
+
+
+class SerializerTest(AsyncTestCase):
+
+    def test_roundtrip(self):
+        value = {'chunks': [u'caf\xe9', {'a': 1}], 'fresh_until': 1.5}
+        for format in ('pickle', 'marshal'):
+            for compress in (None, 'zlib'):
+                serializer = Serializer(format, compress, threshold=0)
+                self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+
+
+    def test_raw_passthrough(self):
+        data = Serializer().dumps(b'<html></html>')
+        self.assertEqual(data, b'\x00<html></html>')
+        self.assertEqual(Serializer().loads(data), b'<html></html>')
+
+
+    def test_compression_threshold(self):
+        serializer = Serializer(threshold=100)
+        self.assertEqual(len(serializer.dumps(b'x' * 99)), 100)
+        self.assertLess(len(serializer.dumps(b'x' * 1000)), 100)
+
+
+    def test_coexisting_formats(self):
+        data = Serializer('marshal', 'zlib', threshold=0).dumps([1, 2])
+        self.assertEqual(Serializer().loads(data), [1, 2])
+        for version in range(3):
+            self.assertEqual(Serializer().loads(pickle.dumps([1, 2], version)), [1, 2])
+        self.assertEqual(Serializer().loads(pickle.dumps('legacy chunk')), 'legacy chunk')
+        self.assertRaises(ValueError, Serializer, 'unknown')
+        self.assertRaises(ValueError, Serializer().loads, b'\x0f')
+
+
+
+class PageHandler(CacheMixin, RequestHandler):
+
+    def get(self):
+        self.application.hits += 1
+        self.write('Hello, ')
+        self.write('world')
+        if self.get_argument('missing', None):
+            self.set_status(404)
+
+
+    def post(self):
+        self.application.hits += 1
+        self.write('posted')
+
+
+
+class SlowHandler(CacheMixin, RequestHandler):
+
+    cache_lock_timeout = 1
+
+    @gen.coroutine
+    def get(self):
+        self.application.hits += 1
+        yield gen.sleep(0.05)
+        self.write('slow')
+
+
+
+
+class JSONHandler(CacheMixin, RequestHandler):
+
+    cache_inline_size = 16
+
+    def get(self):
+        self.application.hits += 1
+        self.set_status(203)
+        self.set_header('Vary', 'Accept-Language')
+        self.set_header('X-Private', 'not replayed')
+        self.write({'items': list(range(int(self.get_argument('size', 1))))})
+
+    @property
+    def cached_status(self):
+        return 200, 203
+
+
+
+class ProductHandler(CacheMixin, RequestHandler):
+
+    def get_cache_tags(self):
+        return ['product:%s' % self.get_argument('id')]
+
+    def get_cache_key_tag(self):
+        return 'product:%s' % self.get_argument('id')
+
+    def get(self):
+        self.application.hits += 1
+        self.write('product')
+
+
+
+class EmptyHandler(CacheMixin, RequestHandler):
+
+    def get(self):
+        self.application.hits += 1
+
+
+
+class StaleHandler(CacheMixin, RequestHandler):
+
+    @cache(expires=60, stale=60)
+    def get(self):
+        self.application.hits += 1
+        self.write(str(self.application.hits))
+
+
+
+class CacheMixinTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = Application([('/', PageHandler), ('/slow', SlowHandler), ('/stale', StaleHandler),
+                           ('/json', JSONHandler), ('/empty', EmptyHandler),
+                           ('/product', ProductHandler)])
+        app.cache = self.cache = DictCache()
+        app.hits  = 0
+        return app
+
+
+    def test_miss_then_hit(self):
+        for _ in range(3):
+            response = self.fetch('/')
+            self.assertEqual(response.body, b'Hello, world')
+        self.assertEqual(self._app.hits, 1)
+        # single lookup per request, single store per miss.
+        self.assertEqual(self.cache.calls, ['get', 'set', 'get', 'get'])
+
+
+    def test_full_response(self):
+        first  = self.fetch('/json')
+        second = self.fetch('/json')
+        self.assertEqual(self._app.hits, 1)
+        self.assertEqual(second.code, 203)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(second.headers['Content-Type'], 'application/json; charset=UTF-8')
+        self.assertEqual(second.headers['Vary'], 'Accept-Language')
+        self.assertNotIn('X-Private', second.headers)
+        self.assertTrue(second.headers['Etag'])
+
+
+    def test_conditional_request(self):
+        etag = self.fetch('/json?size=100').headers['Etag']
+        # large bodies are stored under their own key.
+        self.assertEqual(len(self.cache.data), 2)
+        del self.cache.calls[:]
+        response = self.fetch('/json?size=100', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(self.cache.calls, ['get'])
+        response = self.fetch('/json?size=100')
+        self.assertEqual(response.code, 203)
+        self.assertEqual(self.cache.calls, ['get', 'get', 'get'])
+        self.assertEqual(self._app.hits, 1)
+
+
+    def test_empty_body(self):
+        for _ in range(2):
+            response = self.fetch('/empty')
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, b'')
+        # stored inline, no separate body key.
+        self.assertEqual(len(self.cache.data), 1)
+        self.assertEqual(self._app.hits, 1)
+
+
+    @gen_test
+    def test_invalidate_tags(self):
+        fetch = lambda id: self.http_client.fetch(self.get_url('/product?id=%d' % id))
+        yield [fetch(1), fetch(2), fetch(1), fetch(2)]
+        self.assertEqual(self._app.hits, 2)
+        invalidate_tags(self.cache, 'product:1')
+        yield [fetch(1), fetch(2)]
+        self.assertEqual(self._app.hits, 3)
+        invalidate_tags(self.cache, 'product:*')
+        yield [fetch(1), fetch(2)]
+        self.assertEqual(self._app.hits, 5)
+
+
+    def test_cache_key_tag(self):
+        self.fetch('/product?id=7')
+        keys = [key for key in self.cache.data if not key.startswith('gen:')]
+        self.assertEqual(len(keys), 1)
+        self.assertTrue(keys[0].startswith('{product:7}'))
+
+
+    def test_expand_tags(self):
+        self.assertEqual(expand_tags(['user:42', 'product:*', 'home']),
+                         ['home', 'product:*', 'user:*', 'user:42'])
+
+
+    def test_uncacheable(self):
+        self.fetch('/?missing=1')
+        self.fetch('/?missing=1')
+        self.assertEqual(self._app.hits, 2)
+        self.fetch('/', method='POST', body='')
+        self.assertNotIn('set', self.cache.calls)
+
+
+    @gen_test
+    def test_single_flight(self):
+        responses = yield [self.http_client.fetch(self.get_url('/slow')) for _ in range(5)]
+        self.assertEqual([response.body for response in responses], [b'slow'] * 5)
+        self.assertEqual(self._app.hits, 1)
+        self.assertEqual(self.cache.calls.count('set'), 1)
+        # the distributed lock is released once the response is stored.
+        self.assertEqual([key for key in self.cache.data if key.startswith('lock:')], [])
+
+
+    @gen_test
+    def test_distributed_lock(self):
+        key = 'lock:%s' % self.get_cache_key('/slow')
+        self.cache.data[key] = b'1'
+        data = self.cache.serializer.dumps({'fresh_until': None, 'status': 200, 'headers': [],
+                                           'etag': '"remote"', 'digest': None, 'body': b'remote'})
+        self.io_loop.call_later(0.1, self.cache.data.__setitem__, key[5:], data)
+        responses = yield [self.http_client.fetch(self.get_url('/slow')) for _ in range(5)]
+        # the polling leader hands the remote entry to the coalesced requests.
+        self.assertEqual([response.body for response in responses], [b'remote'] * 5)
+        self.assertEqual(self._app.hits, 0)
+
+
+    @gen_test
+    def test_abandoned_lock(self):
+        key = 'lock:%s' % self.get_cache_key('/slow')
+        self.cache.data[key] = b'1'
+        # the lock holder finished without caching anything.
+        self.io_loop.call_later(0.05, self.cache.data.pop, key)
+        started   = time.time()
+        responses = yield [self.http_client.fetch(self.get_url('/slow')) for _ in range(3)]
+        self.assertEqual([response.body for response in responses], [b'slow'] * 3)
+        self.assertEqual(self._app.hits, 1)
+        self.assertLess(time.time() - started, 0.5)
+
+
+    def test_cache_key(self):
+        key = self.get_cache_key('/?a=1&b=2')
+        self.assertEqual(self.get_cache_key('/?b=2&utm_source=x&a=1'), key)
+        self.assertNotEqual(self.get_cache_key('/?a=1&b=3'), key)
+        SlowHandler.cache_vary = dict(CacheMixin.cache_vary, args=('a',), headers=('X-Device',))
+        try:
+            self.assertEqual(self.get_cache_key('/?a=1&b=3'), self.get_cache_key('/?a=1'))
+            self.assertNotEqual(self.get_cache_key('/?a=1', {'X-Device': 'mobile'}),
+                                self.get_cache_key('/?a=1'))
+        finally:
+            del SlowHandler.cache_vary
+
+
+    def test_cache_key_memoized(self):
+        request = HTTPServerRequest('GET', '/', host='localhost', connection=Connection())
+        handler = SlowHandler(self._app, request)
+        key = handler.get_cache_key()
+        request.path = '/other'
+        self.assertEqual(handler.get_cache_key(), key)
+        self.assertNotEqual(handler.get_cache_key('user'), key)
+
+
+    def get_cache_key(self, path, headers=None):
+        request = HTTPServerRequest('GET', path, host='127.0.0.1:%d' % self.get_http_port(),
+                                    headers=HTTPHeaders(headers or {}), connection=Connection())
+        handler = SlowHandler(self._app, request)
+        return handler.get_cache_key()
+
+
+    @gen_test
+    def test_stale_while_revalidate(self):
+        response = yield self.http_client.fetch(self.get_url('/stale'))
+        self.assertEqual(response.body, b'1')
+        key = self.get_cache_key('/stale')
+        entry = self.cache.serializer.loads(self.cache.data[key])
+        entry['fresh_until'] -= 61
+        self.cache.data[key] = self.cache.serializer.dumps(entry)
+
+        responses = yield [self.http_client.fetch(self.get_url('/stale')) for _ in range(3)]
+        self.assertEqual([response.body for response in responses], [b'1'] * 3)
+        yield gen.sleep(0.01)
+        # single background refresh.
+        self.assertEqual(self._app.hits, 2)
+        response = yield self.http_client.fetch(self.get_url('/stale'))
+        self.assertEqual(response.body, b'2')
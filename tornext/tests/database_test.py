@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+import collections
+
+from sqlalchemy import Column, Integer, String, text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+from tornado import gen
+from tornado.util import ObjectDict
+from tornado.web import Application, RequestHandler
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, gen_test
+
+from tornext import compat
+from tornext.database import (create_async_session_factory, get_pool_size,
+                               ShardRouter, ReplicaSet, DatabaseMixin, ObjectId, replication_lag,
+                               ObjectIdGenerator, ObjectIdType, encode_id, decode_id)
+
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'users'
+
+    id   = Column(Integer, primary_key=True)
+    name = Column(String(32))
+
+
+
+class Event(Base):
+    __tablename__ = 'events'
+
+    id   = Column(ObjectIdType(), primary_key=True, default=ObjectId)
+    seq  = Column(ObjectIdType(bits=64, encoding='base62'))
+
+
+
+def create_factory(path, **options):
+    factory = create_async_session_factory('sqlite:///%s' % os.path.join(path, 'test.db'), **options)
+    Base.metadata.create_all(factory.engine)
+    return factory
+
+
+
+class AsyncSessionTest(AsyncTestCase):
+
+    def setUp(self):
+        super(AsyncSessionTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.factory = create_factory(self.path)
+
+
+    def tearDown(self):
+        self.factory.executor.shutdown()
+        self.factory.engine.dispose()
+        shutil.rmtree(self.path)
+        super(AsyncSessionTest, self).tearDown()
+
+
+    @gen_test
+    def test_unit_of_work(self):
+        session = self.factory()
+        session.add_all([User(name='jim'), User(name='tom')])
+        yield session.commit()
+        users = yield session.all(session.query(User).order_by(User.name))
+        self.assertEqual([user.name for user in users], ['jim', 'tom'])
+        self.assertEqual((yield session.count(session.query(User))), 2)
+        self.assertEqual((yield session.execute('UPDATE users SET name = :name', {'name': 'x'})), 2)
+        yield session.rollback()
+        self.assertEqual((yield session.scalar('SELECT COUNT(*) FROM users WHERE name = :name', {'name': 'x'})), 0)
+        yield session.close()
+
+
+    @gen_test
+    def test_off_ioloop(self):
+        session = self.factory()
+        threads = yield [session.run(lambda session: threading.current_thread()) for _ in range(3)]
+        self.assertNotIn(threading.current_thread(), threads)
+        yield session.close()
+
+
+    @gen_test
+    def test_queued(self):
+        session = self.factory()
+        calls = [session.run(lambda session, index=index: index) for index in range(50)]
+        order = []
+        for future in calls:
+            future.add_done_callback(lambda future: order.append(future.result()))
+        yield calls
+        self.assertEqual(order, list(range(50)))
+        # calls fired without waiting still run in order, close() runs last.
+        session.add(User(name='jim'))
+        session.commit()
+        yield session.close()
+        session = self.factory()
+        self.assertEqual((yield session.count(session.query(User))), 1)
+        yield session.close()
+
+
+    def test_pool_size(self):
+        factory = create_factory(self.path, poolclass=QueuePool, pool_size=3, max_overflow=2)
+        self.assertEqual(get_pool_size(factory.engine), 5)
+        self.assertEqual(factory.executor._max_workers, 5)
+        factory.executor.shutdown()
+        factory.engine.dispose()
+
+
+    @gen_test
+    def test_memory(self):
+        factory = create_async_session_factory('sqlite://')
+        # a single shared connection, used by a single executor thread.
+        self.assertEqual(factory.executor._max_workers, 1)
+        Base.metadata.create_all(factory.engine)
+        session = factory()
+        session.add(User(name='jim'))
+        yield session.commit()
+        yield session.close()
+        session = factory()
+        self.assertEqual((yield session.count(session.query(User))), 1)
+        yield session.close()
+        factory.executor.shutdown()
+        factory.engine.dispose()
+
+
+
+class ShardRouterTest(AsyncTestCase):
+
+    def setUp(self):
+        super(ShardRouterTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.urls = ['sqlite:///%s' % os.path.join(self.path, '%d.db' % x) for x in range(3)]
+        self.router = ShardRouter(self.urls, pools={self.urls[0]: {'poolclass': QueuePool, 'pool_size': 7}})
+        for factory in self.router.factories.values():
+            Base.metadata.create_all(factory.engine)
+
+
+    def tearDown(self):
+        for factory in self.router.factories.values():
+            factory.executor.shutdown()
+            factory.engine.dispose()
+        shutil.rmtree(self.path)
+        super(ShardRouterTest, self).tearDown()
+
+
+    def test_pools(self):
+        self.assertEqual(list(self.router.factories), self.urls)
+        self.assertEqual(get_pool_size(self.router.factories[self.urls[0]].engine), 17)
+        self.assertRaises(ValueError, ShardRouter, self.urls[:1] * 2)
+        self.assertRaises(ValueError, self.router.route)
+
+
+    @gen_test
+    def test_routing(self):
+        ids = [ObjectId() for _ in range(30)]
+        for id in ids:
+            session = self.router(id)
+            session.add(User(name=id))
+            yield session.commit()
+            yield session.close()
+        counts = []
+        for url, factory in self.router.factories.items():
+            session = factory()
+            names = yield session.all(session.query(User.name))
+            counts.append(len(names))
+            self.assertTrue(all(self.router.get_host(name) == url for name, in names))
+            yield session.close()
+        self.assertEqual(sum(counts), 30)
+        self.assertTrue(all(counts))
+
+
+
+class ReplicaSetTest(AsyncTestCase):
+
+    def setUp(self):
+        super(ReplicaSetTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.urls = ['sqlite:///%s' % os.path.join(self.path, '%s.db' % name)
+                     for name in ('primary', 'replica1', 'replica2')]
+        self.lags = {}
+        self.database = create_replica_set(self.urls, lag=lambda session: self.lags.get(str(session.bind.url), 0))
+
+
+    def tearDown(self):
+        dispose_replica_set(self.database)
+        shutil.rmtree(self.path)
+        super(ReplicaSetTest, self).tearDown()
+
+
+    def test_routing(self):
+        primary, replicas = self.database.primary, self.database.replicas
+        self.assertIs(self.database.route(), primary)
+        self.assertIs(self.database().factory, primary)
+        self.assertEqual([self.database.route(readonly=True) for _ in range(4)], replicas * 2)
+
+        self.database.policy = 'least_outstanding'
+        replicas[0].outstanding = 2
+        self.assertIs(self.database.route(readonly=True), replicas[1])
+        self.assertRaises(ValueError, ReplicaSet, self.urls[0], policy='random')
+
+
+    @gen_test
+    def test_outstanding(self):
+        session = self.database.primary()
+        future  = session.run(lambda session: 1)
+        self.assertEqual(self.database.primary.outstanding, 1)
+        yield future
+        self.assertEqual(self.database.primary.outstanding, 0)
+        yield session.close()
+
+
+    @gen_test
+    def test_lag(self):
+        self.lags[self.urls[1]] = 10
+        yield self.database.check()
+        self.assertEqual(self.database.available, self.database.replicas[1:])
+        self.assertIs(self.database.route(readonly=True), self.database.replicas[1])
+        self.assertIsNotNone(self.database.checker)
+
+        self.lags[self.urls[2]] = None
+        yield self.database.check()
+        self.assertIs(self.database.route(readonly=True), self.database.primary)
+
+        self.lags.clear()
+        yield self.database.check()
+        self.assertEqual(self.database.available, self.database.replicas)
+
+
+    @gen_test
+    def test_hung_check(self):
+        release = threading.Event()
+        calls   = []
+
+        def lag(session):
+            calls.append(str(session.bind.url))
+            if calls[-1] == self.urls[1]:
+                release.wait(5)
+            return 0
+        self.database.lag = lag
+        check = self.database.check()
+        yield gen.sleep(0.1)
+        yield self.database.check()
+        # no second session on the hung replica, which is out of rotation meanwhile.
+        self.assertEqual(calls.count(self.urls[1]), 1)
+        self.assertEqual(calls.count(self.urls[2]), 2)
+        self.assertEqual(self.database.available, self.database.replicas[1:])
+        release.set()
+        yield check
+        yield self.database.check()
+        self.assertEqual(self.database.available, self.database.replicas)
+
+
+    def test_replication_lag(self):
+        Status  = collections.namedtuple('Status', ('Seconds_Behind_Master',))
+        session = LagSession('mysql', Status(3))
+        self.assertEqual(replication_lag(session), 3)
+        self.assertIsNone(replication_lag(LagSession('mysql')))
+        self.assertEqual(replication_lag(LagSession('postgresql')), 0.5)
+        self.assertEqual(replication_lag(LagSession('sqlite')), 0)
+        self.assertIsInstance(session.statements[0], type(text('')))
+
+
+
+class LagSession(object):
+    """Session stub answering the lag queries of `dialect`."""
+
+    def __init__(self, dialect, status=None):
+        self.bind   = ObjectDict(dialect=ObjectDict(name=dialect))
+        self.status = status
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return ObjectDict(first=lambda: self.status)
+
+    def scalar(self, statement):
+        self.statements.append(statement)
+        return 0.5
+
+
+
+def create_replica_set(urls, **options):
+    database = ReplicaSet(urls[0], urls[1:], max_lag=1, **options)
+    for factory in [database.primary] + database.replicas:
+        Base.metadata.create_all(factory.engine)
+    return database
+
+
+def dispose_replica_set(database):
+    if database.checker is not None:
+        database.checker.stop()
+    for factory in [database.primary] + database.replicas:
+        factory.executor.shutdown()
+        factory.engine.dispose()
+
+
+
+class ReadHandler(DatabaseMixin, RequestHandler):
+
+    database_readonly = True
+
+    def get(self):
+        self.write(str(self.session.session.bind.url))
+
+    @gen.coroutine
+    def post(self):
+        self.get_session(readonly=False).add(User(name='jim'))
+        yield self.get_session(readonly=False).commit()
+        self.write(str(self.session.session.bind.url))
+
+
+
+class UserHandler(DatabaseMixin, RequestHandler):
+
+    @gen.coroutine
+    def post(self):
+        self.session.add(User(name=self.get_argument('name')))
+        if self.get_argument('commit', None):
+            yield self.session.commit()
+        else:
+            yield self.session.flush()
+        self.application.sessions.append(self.session)
+        self.write(str((yield self.session.count(self.session.query(User)))))
+
+
+
+class DatabaseMixinTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.path = tempfile.mkdtemp()
+        app = Application([('/', UserHandler)])
+        app.database = create_factory(self.path)
+        app.sessions = []
+        return app
+
+
+    def tearDown(self):
+        super(DatabaseMixinTest, self).tearDown()
+        self._app.database.executor.shutdown()
+        self._app.database.engine.dispose()
+        shutil.rmtree(self.path)
+
+
+    def test_request_lifecycle(self):
+        self.assertEqual(self.fetch('/?name=jim', method='POST', body='').body, b'1')
+        # uncommitted changes are rolled back when the request finishes.
+        self.assertEqual(self.fetch('/?name=tom&commit=1', method='POST', body='').body, b'1')
+        self.assertEqual(len(self._app.sessions), 2)
+        self.assertIsNot(self._app.sessions[0], self._app.sessions[1])
+
+
+
+class StickyPrimaryTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.path = tempfile.mkdtemp()
+        self.urls = ['sqlite:///%s' % os.path.join(self.path, '%d.db' % x) for x in range(2)]
+        app = Application([('/', ReadHandler)])
+        app.database = create_replica_set(self.urls)
+        return app
+
+
+    def tearDown(self):
+        super(StickyPrimaryTest, self).tearDown()
+        dispose_replica_set(self._app.database)
+        shutil.rmtree(self.path)
+
+
+    def test_read_your_writes(self):
+        self.assertEqual(self.fetch('/').body, self.urls[1].encode())
+        response = self.fetch('/', method='POST', body='')
+        # reads after a write in the same request stay on the primary.
+        self.assertEqual(response.body, self.urls[0].encode())
+        cookie = response.headers['Set-Cookie'].split(';')[0]
+        self.assertTrue(cookie.startswith('db_primary='))
+        self.assertEqual(self.fetch('/', headers={'Cookie': cookie}).body, self.urls[0].encode())
+        self.assertEqual(self.fetch('/').body, self.urls[1].encode())
+
+
+
+class ObjectIdTest(unittest.TestCase):
+
+    def test_ordering(self):
+        ids = ObjectIdGenerator(bits=64, worker=3)
+        values = [ids() for _ in range(5000)] + ids.bulk(5000)
+        self.assertEqual(values, sorted(set(values)))
+        self.assertTrue(all(0 < value < 2 ** 63 for value in values))
+        hexes = [ObjectId() for _ in range(100)]
+        self.assertEqual(hexes, sorted(hexes))
+        self.assertTrue(all(len(value) == 32 for value in hexes))
+
+
+    def test_clock(self):
+        ids = ObjectIdGenerator(bits=64, worker=1023)
+        ids.timer = lambda: 1500000000.0
+        values = ids.bulk(4097)
+        # counters exhausted within one millisecond borrow the next one.
+        self.assertEqual(ids.timestamp(values[0]), 1500000000.0)
+        self.assertEqual(ids.timestamp(values[-1]), 1500000000.001)
+        ids.timer = lambda: 1400000000.0
+        self.assertTrue(ids() > values[-1])
+        self.assertEqual(values[0] >> 12 & 1023, 1023)
+
+
+    def test_encodings(self):
+        ids = ObjectIdGenerator()
+        values = ids.bulk(100)
+        for encoding, width in (('hex', 32), ('base32', 26), ('base62', 22), ('bytes', 16)):
+            encoded = [ids.encode(value, encoding) for value in values]
+            self.assertEqual(encoded, sorted(encoded))
+            self.assertTrue(all(len(text) == width for text in encoded))
+            self.assertEqual([decode_id(text, encoding) for text in encoded], values)
+        self.assertEqual(encode_id(2 ** 64 - 1, 'base62', bits=64), 'LygHa16AHYF')
+        self.assertEqual(decode_id('7zzzzzzzzzzzz', 'base32'), 2 ** 63 - 1)
+        self.assertRaises(ValueError, decode_id, 'ILOU', 'base32')
+        self.assertRaises(ValueError, ObjectIdGenerator, bits=32)
+
+
+    def test_column_type(self):
+        path = tempfile.mkdtemp()
+        factory = create_factory(path)
+        try:
+            session = factory.factory()
+            session.add_all([Event(seq=value) for value in ObjectIdGenerator(bits=64).bulk(3)])
+            session.flush()
+            session.add(Event(id=ObjectId()))
+            session.commit()
+            events = session.query(Event).order_by(Event.id).all()
+            self.assertTrue(all(isinstance(event.id, compat.IntegerTypes) for event in events))
+            self.assertEqual([event.seq for event in events[:3]], sorted(event.seq for event in events[:3]))
+            self.assertEqual(len(events[0].seq), 11)
+            self.assertEqual(events[-1].seq, None)
+            session.close()
+        finally:
+            factory.executor.shutdown()
+            factory.engine.dispose()
+            shutil.rmtree(path)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tornado import gen
+from tornado.util import ObjectDict
+from tornado.testing import AsyncTestCase, gen_test
+
+from tornext import decos
+from tornext.cache.local import LocalCache
+
+
+
+class AsyncCache(LocalCache):
+    """Non-blocking flavour of `LocalCache`."""
+    blocking = False
+
+    def get(self, key):
+        return gen.maybe_future(super(AsyncCache, self).get(key))
+
+    def set(self, key, value, timeout=None):
+        return gen.maybe_future(super(AsyncCache, self).set(key, value, timeout))
+
+
+
+class Service(object):
+
+    def __init__(self, cache):
+        self.application = ObjectDict(cache=cache)
+        self.calls = 0
+        self.user  = None
+
+    @decos.cache(timeout=60)
+    def price(self, product, currency='USD'):
+        self.calls += 1
+        return '%s %s' % (product, currency)
+
+    @decos.cache(timeout=60, local=10)
+    @gen.coroutine
+    def recommend(self, user):
+        self.calls += 1
+        yield gen.moment
+        raise gen.Return([user, None])
+
+    @decos.cache(timeout=60, vary=lambda self, *args: self.user)
+    def discount(self, product):
+        self.calls += 1
+        return '%s for %s' % (product, self.user)
+
+
+
+class CacheTest(AsyncTestCase):
+
+    def test_function(self):
+        calls = []
+
+        @decos.cache(timeout=60)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual([square(2), square(3), square(2)], [4, 9, 4])
+        self.assertEqual(calls, [2, 3])
+
+
+    def test_method(self):
+        backend = LocalCache()
+        service = Service(backend)
+        self.assertEqual(service.price('apple'), 'apple USD')
+        self.assertEqual(service.price('apple'), 'apple USD')
+        self.assertEqual(service.price('apple', currency='EUR'), 'apple EUR')
+        self.assertEqual(service.calls, 2)
+        # results are shared through the application's cache.
+        self.assertEqual(Service(backend).price('apple'), 'apple USD')
+        self.assertEqual(len(backend), 2)
+        self.assertTrue(all(key.startswith('memo:Service.') for key in backend.entries))
+
+
+    def test_normalized_arguments(self):
+        service = Service(LocalCache())
+        results = [service.price('apple'), service.price(product='apple'),
+                   service.price('apple', currency='USD'), service.price('apple', 'USD')]
+        self.assertEqual(results, ['apple USD'] * 4)
+        self.assertEqual(service.calls, 1)
+
+
+    def test_vary(self):
+        backend = LocalCache()
+        alice, bob = Service(backend), Service(backend)
+        alice.user, bob.user = 'alice', 'bob'
+        self.assertEqual(alice.discount('apple'), 'apple for alice')
+        self.assertEqual(bob.discount('apple'), 'apple for bob')
+        self.assertEqual(Service(backend).discount('apple'), 'apple for None')
+        alice.user = 'bob'
+        self.assertEqual(alice.discount('apple'), 'apple for bob')
+        self.assertEqual(alice.calls + bob.calls, 2)
+        self.assertEqual(len(backend), 3)
+
+
+    @gen_test
+    def test_async_backend(self):
+        backend = AsyncCache()
+        service = Service(backend)
+        # plain functions keep returning plain values, memoized in-process.
+        self.assertEqual(service.price('apple'), 'apple USD')
+        self.assertEqual(service.price('apple'), 'apple USD')
+        self.assertEqual(service.calls, 1)
+        self.assertEqual(len(backend), 0)
+        self.assertEqual((yield service.recommend(7)), [7, None])
+        self.assertEqual((yield Service(backend).recommend(7)), [7, None])
+        self.assertEqual(service.calls, 2)
+        self.assertEqual(len(backend), 1)
+
+
+    @gen_test
+    def test_coroutine(self):
+        backend = LocalCache()
+        service = Service(backend)
+        first  = yield service.recommend(42)
+        second = yield service.recommend(42)
+        self.assertEqual(first, [42, None])
+        self.assertEqual(second, first)
+        self.assertEqual(service.calls, 1)
+        # served from the in-process cache without touching the backend.
+        other = Service(backend)
+        self.assertEqual((yield other.recommend(42)), first)
+        self.assertEqual(other.calls, 0)
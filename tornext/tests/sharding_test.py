@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from tornado.test.util import unittest
+
+from tornext import sharding as module
+from tornext.sharding import Sharding, KetamaSharding, JumpSharding, RendezvousSharding, crc32, hash_tag
+
+
+
+NODES = ['redis://10.0.0.%d' % x for x in range(1, 6)]
+KEYS  = ['key:%d' % x for x in range(2000)]
+
+
+class ShardingTest(unittest.TestCase):
+
+    def test_ring(self):
+        sharding = Sharding(NODES, replicas=64)
+        self.assertEqual(len(sharding.points), 64 * len(NODES))
+        self.assertEqual(list(sharding.points), sorted(sharding.points))
+        self.assertEqual(set(sharding.get_node(key) for key in KEYS), set(NODES))
+        self.assertIsNone(Sharding().get_node('key'))
+        self.assertEqual(list(Sharding().iter_nodes('key')), [])
+
+
+    def test_wrap_around(self):
+        sharding = Sharding(NODES)
+        last = sharding.ring.points[-1]
+        key  = next(key for key in KEYS if crc32(key) > last)
+        self.assertEqual(sharding.get_node_pos(key)[1], 0)
+
+
+    def test_remove_node(self):
+        sharding = Sharding(NODES)
+        owners   = dict((key, sharding.get_node(key)) for key in KEYS)
+        sharding.remove_node(NODES[0])
+        self.assertEqual(len(sharding.points), 128 * (len(NODES) - 1))
+        for key in KEYS:
+            node = sharding.get_node(key)
+            self.assertNotEqual(node, NODES[0])
+            # only the keys of the removed node move.
+            if owners[key] != NODES[0]:
+                self.assertEqual(node, owners[key])
+        sharding.add_node(NODES[0])
+        self.assertEqual(dict((key, sharding.get_node(key)) for key in KEYS), owners)
+
+
+    def test_bulk_build(self):
+        incremental = Sharding()
+        for node in NODES:
+            incremental.add_node(node, 2)
+        incremental.set_weight(NODES[1], 1)
+        bulk = Sharding(dict((node, 2) for node in NODES))
+        bulk.set_weight(NODES[1], 1)
+        self.assertEqual(list(bulk.points), sorted(bulk.points))
+        self.assertEqual(list(bulk.points), list(incremental.points))
+        self.assertEqual(dict((key, bulk.get_node(key)) for key in KEYS),
+                         dict((key, incremental.get_node(key)) for key in KEYS))
+
+
+    def test_iter_nodes(self):
+        sharding = Sharding(NODES)
+        nodes    = list(sharding.iter_nodes('key'))
+        self.assertEqual(sorted(nodes), sorted(NODES))
+        self.assertEqual(nodes[0], sharding.get_node('key'))
+
+
+    def test_diff(self):
+        for strategy in (Sharding, KetamaSharding):
+            old, new = strategy(NODES), strategy(NODES + ['redis://10.0.0.9'])
+            moves = old.diff(new)
+            self.assertTrue(all(move.target == 'redis://10.0.0.9' for move in moves))
+            for key in KEYS:
+                value = old.hash(key)
+                move  = [move for move in moves if move.start <= value < move.stop]
+                if old.get_node(key) == new.get_node(key):
+                    self.assertEqual(move, [])
+                else:
+                    self.assertEqual(move[0][2:], (old.get_node(key), new.get_node(key)))
+            self.assertEqual(new.diff(new), [])
+        self.assertRaises(ValueError, Sharding(NODES).diff, KetamaSharding(NODES))
+
+
+    def test_hash_tags(self):
+        self.assertEqual(hash_tag('{user:42}cart'), 'user:42')
+        self.assertEqual(hash_tag(b'page:{user:42}:{x}'), b'user:42')
+        self.assertEqual(hash_tag('{}user:42'), '{}user:42')
+        self.assertEqual(hash_tag('user:{42'), 'user:{42')
+        for strategy in (Sharding, KetamaSharding, JumpSharding, RendezvousSharding):
+            sharding = strategy(NODES)
+            keys  = ['{user:42}%s' % key for key in KEYS[:100]]
+            nodes = set(sharding.get_node(key) for key in keys)
+            self.assertEqual(nodes, set([sharding.get_node('user:42')]))
+            self.assertEqual(list(sharding.get_nodes(keys)[1]), list(nodes))
+            sharding = strategy(NODES)
+            sharding.hash_tags = False
+            self.assertGreater(len(set(sharding.get_node(key) for key in keys)), 1)
+
+
+    def test_memo(self):
+        for strategy in (Sharding, JumpSharding, RendezvousSharding):
+            sharding = strategy(NODES)
+            sharding.memo_size = 10
+            owners = [sharding.get_node(key) for key in KEYS[:15]]
+            # cleared once full.
+            self.assertEqual(sorted(sharding.memo), sorted(KEYS[10:15]))
+            self.assertEqual(sharding.get_node(KEYS[12]), owners[12])
+            self.assertEqual(sharding.get_node(KEYS[2]), owners[2])
+            self.assertEqual(len(sharding.memo), 6)
+            sharding.add_node('redis://10.0.0.9')
+            self.assertEqual(len(sharding.memo), 0)
+
+
+    def test_save_load(self):
+        path = tempfile.mkdtemp()
+        try:
+            weights = dict((node, 1) for node in NODES)
+            weights[NODES[0]] = 2
+            sharding = KetamaSharding(weights)
+            sharding.remove_node(NODES[1])
+            sharding.save(os.path.join(path, 'ring'))
+            loaded = KetamaSharding.load(os.path.join(path, 'ring'))
+            self.assertEqual(loaded.nodes, sharding.nodes)
+            self.assertEqual(loaded.get_nodes(KEYS)[0], sharding.get_nodes(KEYS)[0])
+            self.assertEqual(list(loaded.iter_nodes('key')), list(sharding.iter_nodes('key')))
+            # the loaded ring stays mutable.
+            loaded.add_node(NODES[1])
+            sharding.add_node(NODES[1])
+            self.assertEqual(list(loaded.ring.points), list(sharding.ring.points))
+            self.assertEqual(list(loaded.ring.owners), list(sharding.ring.owners))
+            self.assertRaises(ValueError, Sharding.load, os.path.join(path, 'ring'))
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_snapshot(self):
+        sharding = Sharding(NODES)
+        ring = sharding.ring
+        self.assertIs(sharding.ring, ring)
+        sharding.add_node('redis://10.0.0.9')
+        self.assertIsNot(sharding.ring, ring)
+        self.assertEqual(len(ring.points), 128 * len(NODES))
+
+
+    def test_get_nodes(self):
+        sharding = Sharding(NODES)
+        expected = [sharding.get_node(key) for key in KEYS]
+        numpy = module.numpy
+        try:
+            for module.numpy in set([numpy, None]):
+                nodes, groups = sharding.get_nodes(KEYS)
+                self.assertEqual(nodes, expected)
+                self.assertEqual(sorted(sum(groups.values(), [])), list(range(len(KEYS))))
+                for node, indexes in groups.items():
+                    self.assertTrue(all(expected[index] == node for index in indexes))
+        finally:
+            module.numpy = numpy
+        self.assertEqual(Sharding().get_nodes(['a', 'b']), ([None, None], {}))
+
+
+
+class StrategyTest(unittest.TestCase):
+
+    def test_strategies(self):
+        for strategy in (Sharding, KetamaSharding, JumpSharding, RendezvousSharding):
+            sharding = strategy(NODES)
+            owners   = [sharding.get_node(key) for key in KEYS]
+            self.assertEqual(set(owners), set(NODES))
+            self.assertEqual(sharding.get_nodes(KEYS)[0], owners)
+            nodes = list(sharding.iter_nodes('key'))
+            self.assertEqual(sorted(nodes), sorted(NODES))
+            self.assertEqual(nodes[0], sharding('key'))
+            # removing a node only moves its own keys.
+            sharding.remove_node(NODES[-1])
+            for key, owner in zip(KEYS, owners):
+                if owner != NODES[-1]:
+                    self.assertEqual(sharding.get_node(key), owner)
+            self.assertIsNone(strategy().get_node('key'))
+
+
+    def test_weights(self):
+        weights = dict((node, 1) for node in NODES)
+        weights[NODES[0]] = 3
+        for strategy in (Sharding, KetamaSharding, RendezvousSharding):
+            sharding = strategy(weights)
+            _, groups = sharding.get_nodes(KEYS)
+            self.assertGreater(len(groups[NODES[0]]), 2 * len(groups[NODES[1]]))
+            # only keys of the re-weighted node move.
+            owners = [sharding.get_node(key) for key in KEYS]
+            sharding.set_weight(NODES[0], 1)
+            for key, owner in zip(KEYS, owners):
+                node = sharding.get_node(key)
+                self.assertTrue(node == owner or owner == NODES[0])
+            self.assertRaises(ValueError, sharding.set_weight, NODES[0], 0)
+        self.assertEqual(len(Sharding(weights).points), 128 * (len(NODES) + 2))
+        self.assertEqual(Sharding(weights).ring.points, Sharding(weights).ring.points)
+
+
+    def test_jump_numbered(self):
+        sharding = JumpSharding(NODES)
+        with self.assertRaises(ValueError):
+            sharding.remove_node(NODES[0])
+        with self.assertRaises(ValueError):
+            JumpSharding({NODES[0]: 2})
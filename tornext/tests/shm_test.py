@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Jim Zhan <jim.zhan@me.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import binascii
+
+from tornado.web import Application, RequestHandler
+from tornado.testing import AsyncHTTPTestCase
+from tornado.test.util import unittest
+
+from tornext.cache import CacheMixin
+from tornext.cache.shm import SharedMemoryCache
+
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SharedMemoryCache(slots=64, slot_size=512, ways=4, stripes=4,
+                                       size_classes=((8, 4096),))
+
+
+    def tearDown(self):
+        self.cache.close()
+
+
+    def test_set_get(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.set('a', b'1'))
+        self.assertTrue(self.cache.set('a', b'22'))
+        self.assertEqual(self.cache.get('a'), b'22')
+        self.assertTrue(self.cache.exists('a'))
+        self.cache.delete('a')
+        self.assertFalse(self.cache.exists('a'))
+        self.assertTrue(self.cache.add('a', b'1'))
+        self.assertFalse(self.cache.add('a', b'2'))
+        self.assertEqual(self.cache.incr('n'), 1)
+        self.assertEqual(self.cache.incr('n', 5), 6)
+        self.assertEqual(self.cache.get_many(['a', 'n', 'x']), [b'1', b'6', None])
+
+
+    def test_ttl(self):
+        self.cache.timer = lambda: 100
+        self.cache.set('a', b'1', 10)
+        self.cache.timer = lambda: 110
+        self.assertIsNone(self.cache.get('a'))
+
+
+    def test_oversized(self):
+        self.cache.set('a', b'1')
+        self.assertFalse(self.cache.set('a', b'x' * 4096))
+        self.assertIsNone(self.cache.get('a'))
+
+
+    def test_size_classes(self):
+        self.assertTrue(self.cache.set('a', b'x' * 2048))
+        self.assertEqual(self.cache.get('a'), b'x' * 2048)
+        self.assertFalse(self.cache.add('a', b'1'))
+        # the large value is dropped once a small one replaces it.
+        self.cache.set('a', b'1')
+        self.assertEqual(self.cache.get('a'), b'1')
+        self.cache.set('a', b'y' * 1024)
+        self.assertEqual(self.cache.get('a'), b'y' * 1024)
+        self.cache.delete('a')
+        self.assertFalse(self.cache.exists('a'))
+
+
+    def test_eviction(self):
+        cache = SharedMemoryCache(slots=4, slot_size=512, ways=4, stripes=1, size_classes=())
+        for x in range(4):
+            cache.set('key:%d' % x, b'1', 100 + x)
+        cache.set('key:4', b'1', 50)
+        # the entry closest to expiry is evicted.
+        self.assertFalse(cache.exists('key:0'))
+        self.assertTrue(all(cache.exists('key:%d' % x) for x in range(1, 5)))
+
+
+    def test_forked_workers(self):
+        pid = os.fork()
+        if pid == 0:
+            self.cache.set('child', b'%d' % os.getpid())
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.cache.get('child'), b'%d' % pid)
+
+
+
+class PageHandler(CacheMixin, RequestHandler):
+
+    def get(self):
+        self.application.hits += 1
+        self.write(binascii.hexlify(os.urandom(20000)))
+
+
+
+class CacheMixinTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        app = Application([('/', PageHandler)])
+        app.cache = SharedMemoryCache(slots=64, slot_size=1024, size_classes=((16, 65536),))
+        app.hits  = 0
+        return app
+
+
+    def tearDown(self):
+        self._app.cache.close()
+        super(CacheMixinTest, self).tearDown()
+
+
+    def test_large_page(self):
+        bodies = [self.fetch('/').body for _ in range(3)]
+        self.assertEqual(len(bodies[0]), 40000)
+        self.assertEqual(bodies, bodies[:1] * 3)
+        self.assertEqual(self._app.hits, 1)